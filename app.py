@@ -1,15 +1,37 @@
-from flask import Flask, render_template, request, redirect, url_for , flash , session , render_template_string
+from flask import Flask, render_template, request, redirect, url_for , flash , session , render_template_string , Response , stream_with_context , stream_template , g , make_response , abort , send_from_directory
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from sqlalchemy.engine import make_url
+from sqlalchemy.schema import CreateColumn
 import os
 import sys
 import click
-from markupsafe import Markup
+from markupsafe import Markup, escape
+from jinja2 import ChoiceLoader, FileSystemBytecodeCache, ModuleLoader, TemplateNotFound
 import markdown2
 import secrets
 from werkzeug.security import generate_password_hash,check_password_hash
 from flask_login import LoginManager , UserMixin , login_user , logout_user , login_required , current_user
 from datetime import datetime , timedelta , timezone
 import re
+import atexit
+import csv
+import gzip
+import itertools
+import json
+import threading
+import time
+import zlib
+import hashlib
+import mimetypes
+import shutil
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from write_queue import GroupCommitQueue
+from worker_pool import BatchWorkerPool
+from cache import SharedValueCache, create_cache
+from blocklist import Blocklist
+from rate_limit import SlidingWindowLimiter
 
 WIN = sys.platform.startswith('win')
 if WIN:
@@ -19,15 +41,333 @@ else:
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('FLASK_SECRET_KEY',secrets.token_hex(16))
-app.config['SQLALCHEMY_DATABASE_URI'] = prefix + os.path.join(app.root_path, 'data.db')
+# 数据库文件位置，测试时指向临时目录
+app.config['DATABASE_FILE'] = os.environ.get('DATABASE_FILE', os.path.join(app.root_path, 'data.db'))
+app.config['SQLALCHEMY_DATABASE_URI'] = prefix + app.config['DATABASE_FILE']
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
+app.config['PROJECTS_PER_PAGE'] = int(os.environ.get('PROJECTS_PER_PAGE', 20))   # 首页每页条数
+app.config['SQLITE_PROFILE'] = os.environ.get('SQLITE_PROFILE', 'dev')
+app.config['SQLITE_PRAGMAS'] = {}   # 在所选 profile 基础上单独覆盖某几项
+app.config['SQLITE_READER_POOL_SIZE'] = int(os.environ.get('SQLITE_READER_POOL_SIZE', 8))
+# 评论/回复的批量提交队列，默认关闭
+app.config['WRITE_QUEUE_ENABLED'] = os.environ.get('WRITE_QUEUE_ENABLED') == '1'
+app.config['WRITE_QUEUE_MAX_DELAY'] = float(os.environ.get('WRITE_QUEUE_MAX_DELAY', 0.005))  # 秒
+app.config['WRITE_QUEUE_BATCH_SIZE'] = int(os.environ.get('WRITE_QUEUE_BATCH_SIZE', 100))
+app.config['WRITE_QUEUE_TIMEOUT'] = 10
+app.config['MARKDOWN_EXTRAS'] = []   # 传给 markdown2 的 extras，修改后用 flask rerender 重新渲染
+app.config['MARKDOWN_CACHE_SIZE'] = 256
+# 页面、片段、markdown 缓存的存放位置：memory 为每个进程一份的 LRU，
+# filesystem / sqlite 存在 CACHE_DIR 下、所有 worker 进程共享，失效也对所有进程生效
+app.config['CACHE_BACKEND'] = os.environ.get('CACHE_BACKEND', 'memory')
+app.config['CACHE_DIR'] = os.environ.get('CACHE_DIR', os.path.join(app.root_path, 'cache'))
+app.config['CACHE_DEFAULT_TTL'] = float(os.environ['CACHE_DEFAULT_TTL']) if os.environ.get('CACHE_DEFAULT_TTL') else None
+app.config['CACHE_STATS_LOG_INTERVAL'] = float(os.environ.get('CACHE_STATS_LOG_INTERVAL', 300))  # 秒，0 表示不记日志
+# 匿名访客 GET 页面的整页缓存
+app.config['PAGE_CACHE_ENABLED'] = os.environ.get('PAGE_CACHE_ENABLED', '1') == '1'
+app.config['PAGE_CACHE_MAX_ENTRIES'] = 2048
+app.config['PAGE_CACHE_MAX_BYTES'] = 32 * 1024 * 1024
+# 超过这个大小的单页不缓存，流式发送的长评论页也不会整页攒在内存里
+app.config['PAGE_CACHE_MAX_ENTRY_BYTES'] = 1024 * 1024
+# 单条评论渲染结果的片段缓存
+app.config['COMMENT_FRAGMENT_MAX_ENTRIES'] = 20000
+app.config['COMMENT_FRAGMENT_MAX_BYTES'] = 32 * 1024 * 1024
+# 评论数超过这个值的讨论串边查边渲染边发送（?stream=1 可强制），每次从游标取 COMMENT_CHUNK_SIZE 条
+app.config['COMMENTS_STREAM_THRESHOLD'] = int(os.environ.get('COMMENTS_STREAM_THRESHOLD', 200))
+app.config['COMMENT_CHUNK_SIZE'] = 200
+app.config['STREAM_FLUSH_BYTES'] = 16 * 1024
+# /api 接口每页默认条数和上限
+app.config['API_PAGE_SIZE'] = 50
+app.config['API_MAX_PAGE_SIZE'] = 200
+app.config['API_BATCH_MAX_IDS'] = 500   # 批量接口一次最多的 id 数，不能超过 SQLite 的参数上限 999
+# 发评论的频率限制：同一 IP、同一署名在任意 COMMENT_RATE_WINDOW 秒内最多 COMMENT_RATE_LIMIT 条。
+# 计数保存在各进程内存里。部署在反向代理后面时，在 RATE_LIMIT_PROXY_HEADERS 里列出代理设置的头
+# （如 X-Forwarded-For），RATE_LIMIT_PROXY_COUNT 是可信代理的层数，取从右数第这么多个地址
+app.config['COMMENT_RATE_LIMIT'] = int(os.environ.get('COMMENT_RATE_LIMIT', 5))
+app.config['COMMENT_RATE_WINDOW'] = int(os.environ.get('COMMENT_RATE_WINDOW', 60))
+app.config['RATE_LIMIT_PROXY_HEADERS'] = [name for name in os.environ.get('RATE_LIMIT_PROXY_HEADERS', '').split(',') if name]
+app.config['RATE_LIMIT_PROXY_COUNT'] = int(os.environ.get('RATE_LIMIT_PROXY_COUNT', 1))
+# 评论先审后发：开启后新评论以 pending 状态入库，由后台线程池批量打分后发布或拒绝
+app.config['MODERATION_ENABLED'] = os.environ.get('MODERATION_ENABLED') == '1'
+app.config['MODERATION_WORKERS'] = int(os.environ.get('MODERATION_WORKERS', 2))
+app.config['MODERATION_BATCH_SIZE'] = 50
+app.config['MODERATION_MAX_DELAY'] = 0.05   # 秒
+app.config['MODERATION_MAX_LINKS'] = 2      # 超过这么多个链接的评论直接拒绝
+app.config['MODERATION_DUPLICATE_WINDOW'] = 24 * 3600    # 秒，同一作者在这段时间内重复发同样的评论算刷屏
+# 评论过滤词表，文件改动后自动重新加载
+app.config['BLOCKLIST_PATH'] = os.environ.get('BLOCKLIST_PATH', os.path.join(app.root_path, 'blocklist.txt'))
+# 站长资料改动时替换这个文件，其他 worker 进程据此刷新缓存
+app.config['OWNER_MARKER_PATH'] = app.config['DATABASE_FILE'] + '-owner'
+# memory 后端的整页缓存用这个标记文件通知其他进程失效
+app.config['PAGE_CACHE_MARKER_PATH'] = app.config['DATABASE_FILE'] + '-pages'
+# 静态资源构建目录（在 static 下），以及需要预先 gzip 的文件类型
+app.config['STATIC_DIST_DIR'] = 'dist'
+app.config['STATIC_GZIP_TYPES'] = ('.css', '.js', '.svg', '.ico', '.txt', '.json', '.html')
+# wsgi.py 里 gzip 中间件的参数
+app.config['GZIP_MIN_SIZE'] = int(os.environ.get('GZIP_MIN_SIZE', 500))
+app.config['GZIP_LEVEL'] = int(os.environ.get('GZIP_LEVEL', 6))
+# 模板编译缓存：字节码缓存目录（可选）和 flask compile-templates 生成的预编译模块目录
+app.config['JINJA_BYTECODE_CACHE_DIR'] = os.environ.get('JINJA_BYTECODE_CACHE_DIR')
+app.config['JINJA_COMPILED_TEMPLATES'] = os.environ.get(
+    'JINJA_COMPILED_TEMPLATES', os.path.join(app.root_path, 'compiled_templates'))
+# 预编译模块默认不用，部署时先 flask compile-templates 再打开
+app.config['JINJA_USE_COMPILED_TEMPLATES'] = os.environ.get('JINJA_USE_COMPILED_TEMPLATES') == '1'
+
+
+def configure_read_write_split(config):
+    """Give the default engine a single serialized writer connection and add a read-only bind."""
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    if url.get_backend_name() != 'sqlite' or url.database in (None, '', ':memory:'):
+        return    # 内存库只有一个连接，没法拆分
+    # 所有写操作排队使用同一个连接，不再互相撞上 database is locked
+    config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {}).update(pool_size=1, max_overflow=0, pool_timeout=30)
+    path = os.path.abspath(url.database).replace('\\', '/')
+    config.setdefault('SQLALCHEMY_BINDS', {})['reader'] = {
+        'url': url.set(database='file:/' + path.lstrip('/'), query={'mode': 'ro', 'uri': 'true'}),
+        'pool_size': config['SQLITE_READER_POOL_SIZE'],
+        'max_overflow': config['SQLITE_READER_POOL_SIZE'],
+    }
+
+
+class RoutingSession(Session):
+    """Send plain SELECTs to the read-only pool and everything else to the writer."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        reader = self._db.engines.get('reader')
+        if (reader is not None and bind is None and not self._flushing
+                and not self.info.get('writing') and getattr(clause, 'is_select', False)):
+            return reader
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+configure_read_write_split(app.config)
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
+
+
+# 会话一旦用上写连接，事务结束前的读也走写连接，保证能读到自己刚写的数据
+@db.event.listens_for(RoutingSession, 'after_begin')
+def session_began(session, transaction, connection):
+    if connection.engine is not db.engines.get('reader'):
+        session.info['writing'] = True
+
+
+@db.event.listens_for(RoutingSession, 'after_transaction_end')
+def session_ended(session, transaction):
+    if transaction.parent is None:
+        session.info.pop('writing', None)
+
+
+# SQLite 连接参数，按场景分组；cache_size 为负数时单位是 KiB
+SQLITE_PROFILES = {
+    'dev': {
+        'busy_timeout': 5000,
+        'journal_mode': 'wal',
+        'synchronous': 'normal',
+        'cache_size': -16000,
+        'mmap_size': 0,
+        'temp_store': 'memory',
+    },
+    'prod': {
+        'busy_timeout': 5000,
+        'journal_mode': 'wal',
+        # WAL 下 normal 提交时不 fsync，断电会丢最近的提交；线上要保证写入确认之后不丢。
+        # 每次提交多一次 fsync，评论写入多时开 WRITE_QUEUE_ENABLED 让一批共用一次
+        'synchronous': 'full',
+        'cache_size': -64000,
+        'mmap_size': 256 * 1024 * 1024,
+        'temp_store': 'memory',
+    },
+    'bulk-load': {
+        'busy_timeout': 30000,
+        'journal_mode': 'wal',
+        'synchronous': 'off',
+        'cache_size': -256000,
+        'mmap_size': 1024 * 1024 * 1024,
+        'temp_store': 'memory',
+    },
+}
+# 这几个 PRAGMA 读回来是数字，比较前先换算
+_PRAGMA_ENUMS = {
+    'synchronous': {'off': 0, 'normal': 1, 'full': 2, 'extra': 3},
+    'temp_store': {'default': 0, 'file': 1, 'memory': 2},
+}
+
+
+def sqlite_pragmas():
+    profile = app.config['SQLITE_PROFILE']
+    if profile not in SQLITE_PROFILES:
+        raise ValueError('Unknown SQLITE_PROFILE %r, expected one of %s'
+                         % (profile, ', '.join(SQLITE_PROFILES)))
+    pragmas = dict(SQLITE_PROFILES[profile])
+    pragmas.update(app.config['SQLITE_PRAGMAS'])
+    return pragmas
+
+
+def read_sqlite_pragmas(cursor, names):
+    values = {}
+    for name in names:
+        row = cursor.execute('PRAGMA %s' % name).fetchone()
+        values[name] = row[0] if row else None
+    return values
+
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record, read_only=False):
+    """Apply the configured PRAGMA profile to a new SQLite connection and verify it."""
+    pragmas = sqlite_pragmas()
+    if read_only:
+        # journal_mode 是库级别的设置，由写连接负责；只读连接再加上 query_only
+        pragmas.pop('journal_mode', None)
+        pragmas['query_only'] = 1
+    cursor = dbapi_connection.cursor()
+    try:
+        # busy_timeout 放在最前面，切换 WAL 时也能等锁
+        for name, value in pragmas.items():
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        actual = read_sqlite_pragmas(cursor, pragmas)
+    finally:
+        cursor.close()
+
+    for name, value in pragmas.items():
+        expected = _PRAGMA_ENUMS.get(name, {}).get(str(value).lower(), value)
+        if str(actual[name]).lower() != str(expected).lower():
+            # 内存库没有 WAL、编译时关掉 mmap 等情况只告警，不阻止启动
+            app.logger.warning('SQLite PRAGMA %s = %s did not take effect (got %s)', name, value, actual[name])
+    connection_record.info['pragmas'] = actual
+
+
+def apply_read_only_pragmas(dbapi_connection, connection_record):
+    apply_sqlite_pragmas(dbapi_connection, connection_record, read_only=True)
+
+
+with app.app_context():
+    for _key, _engine in db.engines.items():
+        if _engine.dialect.name == 'sqlite':
+            db.event.listen(_engine, 'connect',
+                            apply_read_only_pragmas if _key == 'reader' else apply_sqlite_pragmas)
+
+class FreshModuleLoader(ModuleLoader):
+    """ModuleLoader that skips precompiled modules older than their template source."""
+
+    def __init__(self, path, source_loader):
+        super().__init__(path)
+        self.compiled_path = path
+        self.source_loader = source_loader
+
+    def load(self, environment, name, globals=None):
+        _, filename, _ = self.source_loader.get_source(environment, name)
+        compiled = self.compiled_path
+        if os.path.isdir(compiled):
+            compiled = os.path.join(compiled, ModuleLoader.get_module_filename(name))
+        try:
+            stale = os.path.getmtime(compiled) < os.path.getmtime(filename)
+        except OSError:
+            stale = True
+        if stale:
+            # 让 ChoiceLoader 回退到源文件
+            raise TemplateNotFound(name)
+        return super().load(environment, name, globals)
+
+
+def configure_templates():
+    env = app.jinja_env
+    if app.config['JINJA_BYTECODE_CACHE_DIR']:
+        os.makedirs(app.config['JINJA_BYTECODE_CACHE_DIR'], exist_ok=True)
+        env.bytecode_cache = FileSystemBytecodeCache(app.config['JINJA_BYTECODE_CACHE_DIR'])
+    compiled = app.config['JINJA_COMPILED_TEMPLATES']
+    if not app.config['JINJA_USE_COMPILED_TEMPLATES']:
+        return
+    if not compiled or not os.path.exists(compiled):
+        app.logger.warning('JINJA_USE_COMPILED_TEMPLATES is set but %s does not exist', compiled)
+        return
+    # 预编译过且比源文件新的模板直接 import，其余回退到解析 templates/ 下的源文件
+    env.loader = ChoiceLoader([FreshModuleLoader(compiled, env.loader), env.loader])
+
+
+configure_templates()
+
+
+# 原文件名 -> 带内容哈希的文件名，由 flask build-static 生成
+static_manifest = {}
+
+
+def manifest_path():
+    return os.path.join(app.static_folder, app.config['STATIC_DIST_DIR'], 'manifest.json')
+
+
+def load_static_manifest():
+    static_manifest.clear()
+    try:
+        with open(manifest_path(), encoding='utf-8') as f:
+            static_manifest.update(json.load(f))
+    except FileNotFoundError:
+        pass
+
+
+load_static_manifest()
+
+
+@app.url_defaults
+def fingerprint_static_url(endpoint, values):
+    # 模板里照旧写 url_for('static', filename=...)，有构建产物时换成带哈希的文件名
+    if endpoint == 'static' and values.get('filename') in static_manifest:
+        values['filename'] = static_manifest[values['filename']]
+
+
+def serve_static(filename):
+    """Serve static files, preferring a prebuilt .gz and marking fingerprinted files immutable."""
+    dist_prefix = app.config['STATIC_DIST_DIR'] + '/'
+    response = None
+    if filename.startswith(dist_prefix) and 'gzip' in request.accept_encodings:
+        gz_path = os.path.join(app.static_folder, filename + '.gz')
+        if os.path.isfile(gz_path):
+            mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            response = send_from_directory(app.static_folder, filename + '.gz', mimetype=mimetype)
+            response.headers['Content-Encoding'] = 'gzip'
+            response.headers.pop('Content-Disposition', None)
+    if response is None:
+        response = app.send_static_file(filename)
+    if filename.startswith(dist_prefix):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = 365 * 24 * 3600
+        response.cache_control.immutable = True
+        response.vary.add('Accept-Encoding')
+    return response
+
+
+app.view_functions['static'] = serve_static
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 
+SNAPSHOT_FORMAT = 1     # 快照字段有变化时加一，旧 cookie 里的快照自动作废
+
+
+class SessionUser(UserMixin):
+    """Logged-in user rebuilt from the session snapshot instead of a database row."""
+
+    def __init__(self, id, name, username, version):
+        self.id = id
+        self.name = name
+        self.username = username
+        self.version = version
+
+
+def remember_user(user):
+    # session cookie 本身是签名过的，客户端改不了快照
+    session['_user_snapshot'] = [SNAPSHOT_FORMAT, user.id, user.name, user.username, user.version]
+
+
 @login_manager.user_loader
 def load_user(user_id):  # 创建用户加载回调函数，接受用户 ID 作为参数
-    user = User.query.get(int(user_id))  # 用 ID 作为 User 模型的主键查询对应的用户
+    user_id = int(user_id)
+    snapshot = session.get('_user_snapshot')
+    owner = owner_cache.get()
+    # 快照的版本号和当前一致就直接用，不查数据库；改名/改密码后版本号变了才重新查
+    if (snapshot and snapshot[0] == SNAPSHOT_FORMAT and snapshot[1] == user_id
+            and owner is not None and owner.id == user_id and owner.version == snapshot[4]):
+        return SessionUser(*snapshot[1:])
+    user = db.session.get(User, user_id)  # 用 ID 作为 User 模型的主键查询对应的用户
+    if user is not None:
+        remember_user(user)
     return user  # 返回用户对象
 
 #数据库定义
@@ -36,6 +376,9 @@ class User(db.Model,UserMixin):
     name = db.Column(db.String(20))
     username = db.Column(db.String(20))
     password_hash = db.Column(db.String(128))   #采用哈希
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')  # 每次修改自动加一
+
+    __mapper_args__ = {'version_id_col': version}
 
     def set_password(self,password):    #设置密码
         self.password_hash = generate_password_hash(password)
@@ -49,14 +392,19 @@ class Comment(db.Model):
     author = db.Column(db.String(20), nullable=False)
     content = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
-    project_id = db.Column(db.Integer, db.ForeignKey('projects.id'))
+    project_id = db.Column(db.Integer, db.ForeignKey('projects.id'), index=True)
+    reply_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # 冗余的回复数
+    # pending：等待审核；published：显示；rejected：审核未通过，保留备查
+    status = db.Column(db.String(10), nullable=False, default='published', server_default='published')
     admin_replies = db.relationship('AdminReply', backref='comment', lazy='dynamic')
+    # 评论页按 (project_id, status) 过滤、按 id 排序，一个索引全覆盖
+    __table_args__ = (db.Index('ix_comment_project_status', 'project_id', 'status', 'id'),)
 
 class AdminReply(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
-    comment_id = db.Column(db.Integer, db.ForeignKey('comment.id'))
+    comment_id = db.Column(db.Integer, db.ForeignKey('comment.id'), index=True)
 
 
 #用户登录逻辑
@@ -74,6 +422,7 @@ def login():
         # 验证用户名和密码是否一致
         if username == user.username and user.validate_password(password):
             login_user(user)  # 登入用户
+            remember_user(user)
             flash('Login success.')
             return redirect(url_for('index'))  # 重定向到主页
 
@@ -86,6 +435,7 @@ def login():
 @login_required  # 用于视图保护，后面会详细介绍
 def logout():
     logout_user()  # 登出用户
+    session.pop('_user_snapshot', None)
     flash('Goodbye.')
     return redirect(url_for('index'))  # 重定向回首页
 
@@ -99,12 +449,11 @@ def settings():
             flash('Invalid input.')
             return redirect(url_for('settings'))
 
-        current_user.name = name
-        # current_user 会返回当前登录用户的数据库记录对象
-        # 等同于下面的用法
-        # user = User.query.first()
-        # user.name = name
+        # current_user 可能是从 session 快照还原的，修改要落在数据库记录上
+        user = db.session.get(User, current_user.id)
+        user.name = name
         db.session.commit()
+        remember_user(user)
         flash('Settings updated.')
         return redirect(url_for('index'))
 
@@ -115,24 +464,656 @@ def settings():
 class Projects(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(60))
-    content = db.Column(db.Text)
+    content = db.Column(db.Text)    # 渲染好的 HTML
+    source = db.Column(db.Text)     # markdown 原文，旧数据为空
+    rendered_with = db.Column(db.String(16))   # 渲染时所用 markdown 配置的指纹
+    comment_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # 冗余的评论数
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)     # 标题/正文最后修改时间
+    comments_updated_at = db.Column(db.DateTime)    # 评论区最后一次有新评论/回复的时间
     comments = db.relationship('Comment', backref='project', lazy='dynamic')
 
 
+# 计数器在插入/删除评论和回复的同一个事务里用 SQL 自增维护，不会出现读后写的竞争
+def _bump_counter(connection, table, column, row_id, delta):
+    if row_id is None:
+        return
+    connection.execute(
+        db.update(table).where(table.c.id == row_id).values({column: table.c[column] + delta})
+    )
+
+
+# 记录评论区最后变化的时间，评论页的 ETag / Last-Modified 由它算出
+def _touch_comments(connection, project_id=None, comment_id=None):
+    projects = Projects.__table__
+    if comment_id is not None:
+        comments = Comment.__table__
+        project_id = db.select(comments.c.project_id).where(comments.c.id == comment_id).scalar_subquery()
+    if project_id is None:
+        return
+    connection.execute(
+        db.update(projects).where(projects.c.id == project_id).values(comments_updated_at=datetime.utcnow())
+    )
+
+
+@db.event.listens_for(Comment, 'after_insert')
+def comment_inserted(mapper, connection, target):
+    # 待审核的评论还看不见，发布时再计数
+    if target.status != 'published':
+        return
+    _bump_counter(connection, Projects.__table__, 'comment_count', target.project_id, 1)
+    _touch_comments(connection, project_id=target.project_id)
+
+
+@db.event.listens_for(Comment, 'after_delete')
+def comment_deleted(mapper, connection, target):
+    if target.status != 'published':
+        return
+    _bump_counter(connection, Projects.__table__, 'comment_count', target.project_id, -1)
+    _touch_comments(connection, project_id=target.project_id)
+
+
+@db.event.listens_for(AdminReply, 'after_insert')
+def reply_inserted(mapper, connection, target):
+    _bump_counter(connection, Comment.__table__, 'reply_count', target.comment_id, 1)
+    _touch_comments(connection, comment_id=target.comment_id)
+
+
+@db.event.listens_for(AdminReply, 'after_delete')
+def reply_deleted(mapper, connection, target):
+    _bump_counter(connection, Comment.__table__, 'reply_count', target.comment_id, -1)
+    _touch_comments(connection, comment_id=target.comment_id)
+
+
+# 全文索引：FTS5 外部内容表，由触发器在同一事务里同步，ORM 和 Core 写入都能覆盖
+# 项目正文索引 markdown 原文而不是渲染后的 HTML，否则标签名也能搜到；
+# 没有原文的旧数据由 rebuild_search_index 去掉标签后补进来
+PROJECT_SEARCH_DDL = [
+    "CREATE VIRTUAL TABLE projects_fts USING fts5(title, body)",
+    """CREATE TRIGGER projects_fts_ai AFTER INSERT ON projects BEGIN
+        INSERT INTO projects_fts(rowid, title, body) VALUES (new.id, new.title, coalesce(new.source, ''));
+    END""",
+    """CREATE TRIGGER projects_fts_ad AFTER DELETE ON projects BEGIN
+        DELETE FROM projects_fts WHERE rowid = old.id;
+    END""",
+    """CREATE TRIGGER projects_fts_au AFTER UPDATE OF title, source ON projects BEGIN
+        DELETE FROM projects_fts WHERE rowid = old.id;
+        INSERT INTO projects_fts(rowid, title, body) VALUES (new.id, new.title, coalesce(new.source, ''));
+    END""",
+]
+COMMENT_SEARCH_DDL = [
+    "CREATE VIRTUAL TABLE comment_fts USING fts5(content, content='comment', content_rowid='id')",
+    """CREATE TRIGGER comment_fts_ai AFTER INSERT ON comment BEGIN
+        INSERT INTO comment_fts(rowid, content) VALUES (new.id, new.content);
+    END""",
+    """CREATE TRIGGER comment_fts_ad AFTER DELETE ON comment BEGIN
+        INSERT INTO comment_fts(comment_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END""",
+    """CREATE TRIGGER comment_fts_au AFTER UPDATE OF content ON comment BEGIN
+        INSERT INTO comment_fts(comment_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO comment_fts(rowid, content) VALUES (new.id, new.content);
+    END""",
+]
+SEARCH_INDEX_DDL = PROJECT_SEARCH_DDL + COMMENT_SEARCH_DDL
+SEARCH_INDEX_TABLES = ('projects_fts', 'comment_fts')
+
+
+def rebuild_search_index(connection, optimize=True):
+    connection.execute(db.text('DELETE FROM projects_fts'))
+    connection.execute(db.text(
+        "INSERT INTO projects_fts(rowid, title, body) SELECT id, title, source FROM projects"
+        " WHERE coalesce(source, '') != ''"))
+    legacy = connection.execute(db.text(
+        "SELECT id, title, content FROM projects WHERE coalesce(source, '') = ''")).all()
+    if legacy:
+        connection.execute(db.text('INSERT INTO projects_fts(rowid, title, body) VALUES (:id, :title, :body)'),
+                           [{'id': row.id, 'title': row.title, 'body': Markup(row.content or '').striptags()}
+                            for row in legacy])
+    connection.execute(db.text("INSERT INTO comment_fts(comment_fts) VALUES ('rebuild')"))
+    for name in SEARCH_INDEX_TABLES:
+        if optimize:
+            connection.execute(db.text("INSERT INTO %s(%s) VALUES ('optimize')" % (name, name)))
+
+
+@db.event.listens_for(db.metadata, 'after_create')
+def create_search_index(target, connection, **kw):
+    if connection.dialect.name != 'sqlite':
+        return
+    # 旧库的 projects 还没有 source 列，触发器和重建都会失败，留给 upgrade_schema 加完列再建
+    columns = {column['name'] for column in db.inspect(connection).get_columns('projects')}
+    if 'source' in columns:
+        ensure_search_index(connection)
+
+
+def ensure_search_index(connection):
+    """Create and fill the search index if the database does not have one yet."""
+    if db.inspect(connection).has_table('projects_fts'):
+        return
+    for ddl in SEARCH_INDEX_DDL:
+        connection.execute(db.text(ddl))
+    # 已有数据的库第一次建索引时要全量灌一遍
+    rebuild_search_index(connection, optimize=False)
+
+
+@db.event.listens_for(db.metadata, 'before_drop')
+def drop_search_index(target, connection, **kw):
+    if connection.dialect.name != 'sqlite':
+        return
+    for name in SEARCH_INDEX_TABLES:
+        connection.execute(db.text('DROP TABLE IF EXISTS %s' % name))
+
+
+def fts_query(text):
+    """Turn free text into an FTS5 query that matches all words, ignoring FTS syntax."""
+    terms = ['"%s"' % term.replace('"', '""') for term in text.split()]
+    return ' '.join(terms)
+
+
+def search_content(text, page=1, per_page=20):
+    """Return one page of ranked project/comment hits and whether there is a next page."""
+    query = fts_query(text)
+    if not query:
+        return [], False
+    # snippet 先用控制字符标出命中位置，转义之后再换成 <mark>，评论内容不能原样输出；
+    # .columns() 让这条语句被当作 SELECT，走只读连接池
+    rows = db.session.execute(db.text("""
+        SELECT 'project' AS kind, p.id AS project_id, p.title AS title,
+               snippet(projects_fts, -1, char(2), char(3), '...', 16) AS snippet,
+               bm25(projects_fts, 10.0, 1.0) AS rank
+        FROM projects_fts JOIN projects p ON p.id = projects_fts.rowid
+        WHERE projects_fts MATCH :query
+        UNION ALL
+        SELECT 'comment', c.project_id, p.title,
+               snippet(comment_fts, 0, char(2), char(3), '...', 16),
+               bm25(comment_fts)
+        FROM comment_fts JOIN comment c ON c.id = comment_fts.rowid
+        JOIN projects p ON p.id = c.project_id
+        WHERE comment_fts MATCH :query AND c.status = 'published'
+        ORDER BY rank
+        LIMIT :limit OFFSET :offset
+    """).columns(), {'query': query, 'limit': per_page + 1, 'offset': (page - 1) * per_page}).all()
+    results = []
+    for row in rows[:per_page]:
+        snippet = str(escape(row.snippet)).replace('\x02', '<mark>').replace('\x03', '</mark>')
+        results.append(dict(row._mapping, snippet=Markup(snippet)))
+    return results, len(rows) > per_page
+
+
+def markdown_fingerprint(extras=None):
+    """Short digest of the markdown2 version and options, stored with each rendered document."""
+    extras = app.config['MARKDOWN_EXTRAS'] if extras is None else extras
+    options = json.dumps([markdown2.__version__, sorted(extras)])
+    return hashlib.sha256(options.encode('utf-8')).hexdigest()[:16]
+
+
+def _render_html(source, extras):
+    return str(markdown2.markdown(source, extras=list(extras)))
+
+
+def make_cache(namespace, max_entries, max_bytes=None):
+    """Create the named cache on the backend selected by CACHE_BACKEND."""
+    return create_cache(app.config['CACHE_BACKEND'], namespace, directory=app.config['CACHE_DIR'],
+                        max_entries=max_entries, max_bytes=max_bytes,
+                        default_ttl=app.config['CACHE_DEFAULT_TTL'])
+
+
+markdown_cache = make_cache('markdown', max_entries=app.config['MARKDOWN_CACHE_SIZE'])
+
+
+def render_markdown(source):
+    """Render markdown to HTML, memoized by content digest and renderer options."""
+    fingerprint = markdown_fingerprint()
+    key = (hashlib.sha256(source.encode('utf-8')).digest(), fingerprint)
+    html = markdown_cache.get(key)
+    if html is None:
+        html = _render_html(source, app.config['MARKDOWN_EXTRAS'])
+        markdown_cache.set(key, html, size=len(html))
+    return Markup(html), fingerprint
+
+
+def _render_batch(batch):
+    # 在子进程里执行，只做纯计算
+    extras, rows = batch
+    return [(project_id, _render_html(source, extras)) for project_id, source in rows]
+
+
+def insert_queued_rows(connection, items):
+    """Insert a batch of queued (table, values) rows and bump the counters they affect."""
+    ids = [None] * len(items)
+    positions = {}
+    for i, (table, values) in enumerate(items):
+        positions.setdefault(table, []).append(i)
+    for table, indexes in positions.items():
+        result = connection.execute(
+            table.insert().returning(table.c.id, sort_by_parameter_order=True),
+            [items[i][1] for i in indexes],
+        )
+        for i, row_id in zip(indexes, result.scalars()):
+            ids[i] = row_id
+
+    # Core 插入不会触发 ORM 事件，计数器在这里按批合并更新
+    new_comments = Counter(values['project_id'] for table, values in items
+                           if table is Comment.__table__ and values.get('status', 'published') == 'published')
+    new_replies = Counter(values['comment_id'] for table, values in items if table is AdminReply.__table__)
+    for project_id, count in new_comments.items():
+        _bump_counter(connection, Projects.__table__, 'comment_count', project_id, count)
+        _touch_comments(connection, project_id=project_id)
+    for comment_id, count in new_replies.items():
+        _bump_counter(connection, Comment.__table__, 'reply_count', comment_id, count)
+        _touch_comments(connection, comment_id=comment_id)
+    return ids
+
+
+_write_queue = None
+_write_queue_lock = threading.Lock()
+
+
+def write_queue():
+    global _write_queue
+    with _write_queue_lock:
+        # fork 出来的 worker 没有父进程的写线程，需要各自新建
+        if _write_queue is None or _write_queue[0] != os.getpid():
+            _write_queue = (os.getpid(), GroupCommitQueue(
+                db.engine, insert_queued_rows,
+                max_delay=app.config['WRITE_QUEUE_MAX_DELAY'],
+                batch_size=app.config['WRITE_QUEUE_BATCH_SIZE'],
+            ))
+        return _write_queue[1]
+
+
+@atexit.register
+def close_write_queue():
+    global _write_queue
+    with _write_queue_lock:
+        if _write_queue is not None and _write_queue[0] == os.getpid():
+            _write_queue[1].close()
+        _write_queue = None
+
+
+def queued_insert(model, **values):
+    """Insert one row through the group-commit queue and wait until its batch is committed.
+
+    Returns the new row id, or None if the batch has not committed within WRITE_QUEUE_TIMEOUT;
+    the row stays queued then and may still be committed later.
+    """
+    future = write_queue().submit((model.__table__, values))
+    try:
+        row_id = future.result(timeout=app.config['WRITE_QUEUE_TIMEOUT'])
+    except FutureTimeout:
+        app.logger.warning('%s insert still queued after %ss', model.__tablename__, app.config['WRITE_QUEUE_TIMEOUT'])
+        return None
+    # 和 commit 一样让会话里的对象过期，之后读到的计数器是最新的
+    db.session.expire_all()
+    return row_id
+
+
 @app.cli.command()
 @click.option('--drop', is_flag=True, help='Create after drop.')
 def initdb(drop):
     if drop:  # init the database
         db.drop_all()
     db.create_all()
+    upgrade_schema()
     click.echo('Initialized database')
 
+
+def upgrade_schema():
+    """Add columns and indexes that were introduced after the database was created."""
+    added = set()
+    with db.engine.begin() as conn:
+        # 写连接池只有一个连接，反射也要走同一个连接
+        inspector = db.inspect(conn)
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    ddl = CreateColumn(column).compile(dialect=conn.dialect)
+                    conn.execute(db.text('ALTER TABLE %s ADD COLUMN %s' % (table.name, ddl)))
+                    added.add((table.name, column.name))
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+        # 旧版 projects_fts 是指向 projects.content（HTML）的外部内容表，换成纯文本索引
+        old_index = conn.execute(db.text("SELECT sql FROM sqlite_master WHERE name = 'projects_fts'")).scalar()
+        if old_index and "content='projects'" in old_index:
+            for trigger in ('projects_fts_ai', 'projects_fts_ad', 'projects_fts_au'):
+                conn.execute(db.text('DROP TRIGGER IF EXISTS %s' % trigger))
+            conn.execute(db.text('DROP TABLE projects_fts'))
+            for ddl in PROJECT_SEARCH_DDL:
+                conn.execute(db.text(ddl))
+            rebuild_search_index(conn)
+        elif conn.dialect.name == 'sqlite':
+            ensure_search_index(conn)
+
+    # 新加的计数器列都是 0，要按现有数据补齐（写连接只有一个，等上面的事务结束再算）
+    if added & {('projects', 'comment_count'), ('comment', 'reply_count')}:
+        rebuild_counters()
+
+
+def rebuild_counters():
+    """Recompute every comment/reply counter and return the rows that had drifted."""
+    projects = Projects.__table__
+    comments = Comment.__table__
+    replies = AdminReply.__table__
+    actual_comments = (db.select(db.func.count()).select_from(comments)
+                       .where(comments.c.project_id == projects.c.id, comments.c.status == 'published')
+                       .scalar_subquery())
+    actual_replies = (db.select(db.func.count()).select_from(replies)
+                      .where(replies.c.comment_id == comments.c.id).scalar_subquery())
+
+    drifted = []
+    for table, column, actual in ((projects, 'comment_count', actual_comments),
+                                  (comments, 'reply_count', actual_replies)):
+        rows = db.session.execute(
+            db.select(table.c.id, table.c[column], actual).where(table.c[column] != actual)
+        ).all()
+        drifted.extend((table.name, row_id, column, stored, real) for row_id, stored, real in rows)
+        # 无论是否有偏差都整体重建一遍
+        db.session.execute(db.update(table).values({column: actual}))
+
+    db.session.commit()
+    return drifted
+
+
+@app.cli.command()
+def recount():
+    """Rebuild comment counters and report drift."""
+    drifted = rebuild_counters()
+    if drifted:
+        clear_pages()
+    for name, row_id, column, stored, real in drifted:
+        click.echo('%s %d: %s %d -> %d' % (name, row_id, column, stored, real))
+    click.echo('Recounted, %d counter(s) drifted.' % len(drifted))
+
+
+IMPORT_MODELS = {'projects': Projects, 'comments': Comment, 'replies': AdminReply}
+
+
+def read_records(path, fmt):
+    """Yield one dict per JSONL line or CSV row without loading the whole file."""
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8', newline='') as f:
+        if fmt == 'csv':
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def coerce_record(table, record):
+    """Keep only the table's columns and convert CSV/JSON strings to column types."""
+    row = {}
+    for column in table.columns:
+        if column.name not in record:
+            continue
+        value = record[column.name]
+        if value == '' and column.nullable:
+            value = None
+        elif isinstance(value, str):
+            python_type = column.type.python_type
+            if python_type is datetime:
+                value = datetime.fromisoformat(value)
+            elif python_type is int:
+                value = int(value)
+        row[column.name] = value
+    return row
+
+
+def load_records(table, records, offset, batch_size, commit_every, defer_indexes):
+    """Insert records into table with executemany in large transactions; return the next offset."""
+    indexes = list(table.indexes) if defer_indexes else []
+    started = time.monotonic()
+    done = offset
+    with db.engine.connect() as conn:
+        for index in indexes:
+            index.drop(conn, checkfirst=True)
+        conn.commit()
+
+        try:
+            records = itertools.islice(records, offset, None)
+            while True:
+                # 每个事务写 commit_every 行，内部按 batch_size 分批 executemany
+                chunk_rows = 0
+                with conn.begin():
+                    while chunk_rows < commit_every:
+                        batch = [coerce_record(table, record)
+                                 for record in itertools.islice(records, min(batch_size, commit_every - chunk_rows))]
+                        if not batch:
+                            break
+                        conn.execute(table.insert(), batch)
+                        chunk_rows += len(batch)
+                if not chunk_rows:
+                    break
+                done += chunk_rows
+                rate = (done - offset) / max(time.monotonic() - started, 1e-6)
+                click.echo('Committed %d records (%.0f rows/s), resume with --offset %d' % (done, rate, done), err=True)
+        finally:
+            # 出错或 Ctrl-C 中断时也要把索引建回来，续传时用 --offset 接着导
+            if indexes:
+                conn.rollback()
+                click.echo('Rebuilding %d index(es)...' % len(indexes), err=True)
+                for index in indexes:
+                    index.create(conn, checkfirst=True)
+                conn.commit()
+
+    return done
+
+
+@app.cli.command('import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--model', 'model_name', type=click.Choice(sorted(IMPORT_MODELS)), required=True,
+              help='Which table the records go into.')
+@click.option('--format', 'fmt', type=click.Choice(['jsonl', 'csv']), default=None,
+              help='Input format, guessed from the file name by default.')
+@click.option('--offset', default=0, show_default=True, help='Skip this many records (resume an import).')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows per executemany call.')
+@click.option('--commit-every', default=50000, show_default=True, help='Rows per transaction.')
+@click.option('--defer-indexes', is_flag=True, help='Drop secondary indexes during the load and rebuild them after.')
+def import_data(path, model_name, fmt, offset, batch_size, commit_every, defer_indexes):
+    """Bulk import projects, comments or replies from JSONL/CSV."""
+    if fmt is None:
+        name = path[:-3] if path.endswith('.gz') else path
+        fmt = 'csv' if name.endswith('.csv') else 'jsonl'
+    table = IMPORT_MODELS[model_name].__table__
+    db.create_all()
+    upgrade_schema()
+    started = time.monotonic()
+
+    # 导入期间换成 bulk-load 配置，连接池清空后新连接才会用上
+    profile = app.config['SQLITE_PROFILE']
+    app.config['SQLITE_PROFILE'] = 'bulk-load'
+    db.engine.dispose()
+    try:
+        done = load_records(table, read_records(path, fmt), offset, batch_size, commit_every, defer_indexes)
+    finally:
+        app.config['SQLITE_PROFILE'] = profile
+        db.engine.dispose()
+
+    rebuild_counters()
+    clear_pages()
+    click.echo('Imported %d %s in %.1fs.' % (done - offset, model_name, time.monotonic() - started))
+
+
+EXPORT_MODELS = dict(IMPORT_MODELS, users=User)
+# 只导出这些列的表；users 不能带上 password_hash
+EXPORT_COLUMNS = {'users': ('id', 'name', 'username', 'version')}
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError('%r is not JSON serializable' % (value,))
+
+
+def export_lines(model_names, rows_per_fetch=1000):
+    """Yield every row of the given tables as one JSON line, fetching rows in small batches."""
+    # 从只读连接池读，WAL 下不会挡住写操作
+    engine = db.engines.get('reader', db.engine)
+    with engine.connect() as conn:
+        for name in model_names:
+            table = EXPORT_MODELS[name].__table__
+            columns = [table.c[column] for column in EXPORT_COLUMNS.get(name, table.c.keys())]
+            result = conn.execution_options(yield_per=rows_per_fetch).execute(
+                db.select(*columns).order_by(table.c.id))
+            for row in result.mappings():
+                record = {'table': name}
+                record.update(row)
+                yield json.dumps(record, default=_json_default, ensure_ascii=False) + '\n'
+
+
+def export_chunks(model_names, compress=False, chunk_size=64 * 1024):
+    """Group exported lines into byte chunks of about chunk_size, gzip-compressed if asked."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None   # 31 = gzip 格式
+    buffer, size = [], 0
+    for line in export_lines(model_names):
+        data = line.encode('utf-8')
+        buffer.append(data)
+        size += len(data)
+        if size >= chunk_size:
+            chunk = b''.join(buffer)
+            buffer, size = [], 0
+            if compressor:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                yield chunk
+    chunk = b''.join(buffer)
+    if compressor:
+        chunk = compressor.compress(chunk) + compressor.flush()
+    if chunk:
+        yield chunk
+
+
+@app.cli.command('export')
+@click.argument('output', type=click.File('wb'), default='-')
+@click.option('--model', 'model_names', type=click.Choice(sorted(EXPORT_MODELS)), multiple=True,
+              help='Only export these tables (repeatable). Defaults to all of them.')
+@click.option('--gzip', 'compress', is_flag=True, help='Gzip the output.')
+def export_data(output, model_names, compress):
+    """Export the site as JSONL."""
+    for chunk in export_chunks(model_names or list(EXPORT_MODELS), compress=compress):
+        output.write(chunk)
+
+
+@app.cli.command()
+def reindex():
+    """Rebuild and optimize the full-text search index."""
+    db.create_all()
+    upgrade_schema()
+    with db.engine.begin() as conn:
+        rebuild_search_index(conn)
+    click.echo('Search index rebuilt.')
+
+
+@app.cli.command()
+@click.option('--all', 'render_all', is_flag=True, help='Re-render every document, not only stale ones.')
+@click.option('--workers', default=None, type=int, help='Number of worker processes.')
+@click.option('--batch-size', default=200, show_default=True, help='Documents per worker task.')
+def rerender(render_all, workers, batch_size):
+    """Re-render markdown documents whose renderer settings changed."""
+    table = Projects.__table__
+    extras = tuple(app.config['MARKDOWN_EXTRAS'])
+    fingerprint = markdown_fingerprint()
+    query = db.select(table.c.id, table.c.source).where(table.c.source.is_not(None)).order_by(table.c.id)
+    if not render_all:
+        query = query.where(db.or_(table.c.rendered_with.is_(None), table.c.rendered_with != fingerprint))
+    update = (db.update(table).where(table.c.id == db.bindparam('project_id'))
+              .values(content=db.bindparam('html'), rendered_with=fingerprint, updated_at=db.bindparam('now')))
+
+    def write(results):
+        # 页面内容变了，updated_at 也要跟着变，否则浏览器拿旧 ETag 还会得到 304
+        now = datetime.utcnow()
+        with db.engine.begin() as conn:
+            conn.execute(update, [{'project_id': project_id, 'html': html, 'now': now} for project_id, html in results])
+        invalidate_pages('api:projects', *['project:%d' % project_id for project_id, _ in results])
+        return len(results)
+
+    done = 0
+    reader = db.engines.get('reader', db.engine)
+    with ProcessPoolExecutor(max_workers=workers) as executor, reader.connect() as conn:
+        rows = conn.execution_options(yield_per=batch_size).execute(query)
+        # 一次只把有限个批次交给进程池，内存不随文档数量增长
+        window = (workers or os.cpu_count() or 1) * 2
+        while True:
+            batches = [(extras, [tuple(row) for row in chunk])
+                       for chunk in itertools.islice(iter(lambda: rows.fetchmany(batch_size), []), window)]
+            if not batches:
+                break
+            for results in executor.map(_render_batch, batches):
+                done += write(results)
+            click.echo('Re-rendered %d documents' % done, err=True)
+    click.echo('Done, %d document(s) re-rendered.' % done)
+
+
+@app.cli.command('compile-templates')
+@click.option('--target', default=None, help='Output directory, defaults to JINJA_COMPILED_TEMPLATES.')
+@click.option('--zip', 'as_zip', is_flag=True, help='Write a zip archive instead of a directory.')
+def compile_templates(target, as_zip):
+    """Precompile all templates into Python modules."""
+    target = target or app.config['JINJA_COMPILED_TEMPLATES']
+    # 用原始的模板加载器编译，ModuleLoader 没法列出模板
+    env = app.jinja_env.overlay(loader=app.create_global_jinja_loader())
+    names = env.list_templates()
+    env.compile_templates(target, zip='deflated' if as_zip else None, ignore_errors=False)
+    click.echo('Compiled %d templates into %s' % (len(names), target))
+
+
+@app.cli.command('build-static')
+def build_static():
+    """Write fingerprinted and gzipped copies of the static files."""
+    static_root = app.static_folder
+    dist = os.path.join(static_root, app.config['STATIC_DIST_DIR'])
+    shutil.rmtree(dist, ignore_errors=True)
+    manifest = {}
+    for root, dirs, files in os.walk(static_root):
+        if os.path.abspath(root).startswith(os.path.abspath(dist)):
+            continue
+        for name in sorted(files):
+            source = os.path.join(root, name)
+            relative = os.path.relpath(source, static_root).replace(os.sep, '/')
+            with open(source, 'rb') as f:
+                data = f.read()
+            stem, ext = os.path.splitext(relative)
+            hashed = '%s/%s.%s%s' % (app.config['STATIC_DIST_DIR'], stem, hashlib.sha256(data).hexdigest()[:12], ext)
+            target = os.path.join(static_root, hashed)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as f:
+                f.write(data)
+            if ext.lower() in app.config['STATIC_GZIP_TYPES']:
+                # mtime=0 让相同内容每次构建出相同的 .gz
+                with open(target + '.gz', 'wb') as f:
+                    f.write(gzip.compress(data, compresslevel=9, mtime=0))
+            manifest[relative] = hashed
+            click.echo('%s -> %s' % (relative, hashed))
+    with open(manifest_path(), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    load_static_manifest()
+    click.echo('Built %d static files.' % len(manifest))
+
+
+@app.cli.command()
+def pragmas():
+    """Show the active SQLite settings."""
+    click.echo('Profile: %s' % app.config['SQLITE_PROFILE'])
+    wanted = sqlite_pragmas()
+    with db.engine.connect() as conn:
+        cursor = conn.connection.cursor()
+        try:
+            actual = read_sqlite_pragmas(cursor, wanted)
+        finally:
+            cursor.close()
+    for name, value in wanted.items():
+        click.echo('%-13s %-12s (configured: %s)' % (name, actual[name], value))
+
+
 @app.cli.command()
 @click.option('--username', prompt=True, help='The username used to login.')
 @click.option('--password', prompt=True, hide_input=True, confirmation_prompt=True, help='The password used to login.')
 def admin(username, password):
     """Create user."""
     db.create_all()
+    upgrade_schema()
 
     user = User.query.first()
     if user is not None:
@@ -149,10 +1130,246 @@ def admin(username, password):
     click.echo('Done.')
 
 
+OwnerProfile = namedtuple('OwnerProfile', 'id name username version')
+
+
+def load_owner():
+    row = db.session.execute(
+        db.select(User.id, User.name, User.username, User.version).order_by(User.id).limit(1)
+    ).first()
+    return OwnerProfile(*row) if row is not None else None
+
+
+owner_cache = SharedValueCache(load_owner, app.config['OWNER_MARKER_PATH'])
+
+
+# 用户表提交了改动（settings()、flask admin 等）之后才刷新站长缓存
+@db.event.listens_for(User, 'after_insert')
+@db.event.listens_for(User, 'after_update')
+@db.event.listens_for(User, 'after_delete')
+def user_changed(mapper, connection, target):
+    db.inspect(target).session.info['owner_changed'] = True
+
+
+@db.event.listens_for(RoutingSession, 'after_commit')
+def bump_owner_version(session):
+    if session.info.pop('owner_changed', False):
+        owner_cache.bump()
+        invalidate_pages('owner')   # 每个页面都显示站长名字
+
+
+@db.event.listens_for(RoutingSession, 'after_rollback')
+def forget_owner_change(session):
+    session.info.pop('owner_changed', None)
+
+
 @app.context_processor
 def inject_user():
-    user = User.query.first()
-    return dict(user=user)
+    return dict(user=owner_cache.get())
+
+
+page_cache = make_cache('pages', max_entries=app.config['PAGE_CACHE_MAX_ENTRIES'],
+                        max_bytes=app.config['PAGE_CACHE_MAX_BYTES'])
+
+
+def page_tags():
+    """Tags of the cached page for the current request, or None if it is not cacheable."""
+    if (not app.config['PAGE_CACHE_ENABLED'] or request.method != 'GET'
+            or '_user_id' in session or '_flashes' in session):
+        return None     # 登录用户和带提示消息的页面不缓存
+    project_id = (request.view_args or {}).get('project_id')
+    if request.endpoint == 'index':
+        return ('owner', 'index')
+    if request.endpoint == 'view_project':
+        return ('owner', 'project:%d' % project_id)
+    if request.endpoint == 'comments':
+        return ('owner', 'comments:%d' % project_id)
+    # JSON 接口不显示站长资料，只跟数据本身走
+    if request.endpoint == 'api_projects':
+        return ('index', 'api:projects')
+    if request.endpoint == 'api_project':
+        return ('project:%d' % project_id, 'comments:%d' % project_id)
+    if request.endpoint == 'api_comments':
+        return ('comments:%d' % project_id,)
+    return None
+
+
+# memory 后端的整页缓存每个进程各有一份，失效只落在当前进程。其他 worker 和 flask 命令
+# 失效页面时更新标记文件，本进程查缓存前发现标记变了就清空自己那份（没法按标签，只能整体清）。
+# filesystem / sqlite 后端本身是共享的，不需要这一步
+page_cache_marker = SharedValueCache(object, app.config['PAGE_CACHE_MARKER_PATH'])
+_page_generation = None
+
+
+def sync_page_cache():
+    """Drop this process's cached pages if another process has invalidated pages since."""
+    global _page_generation
+    if app.config['CACHE_BACKEND'] != 'memory':
+        return
+    generation = page_cache_marker.get()
+    if generation is not _page_generation:
+        page_cache.clear()
+        _page_generation = generation
+
+
+def _announce_page_change():
+    global _page_generation
+    if app.config['CACHE_BACKEND'] == 'memory':
+        page_cache_marker.bump()
+        _page_generation = page_cache_marker.get()  # 本进程已经处理过了，不用再清一遍
+
+
+def invalidate_pages(*tags):
+    page_cache.invalidate(*tags)
+    _announce_page_change()
+
+
+def clear_pages():
+    page_cache.clear()
+    _announce_page_change()
+
+
+@app.before_request
+def serve_cached_page():
+    tags = page_tags()
+    if tags is None:
+        return None
+    sync_page_cache()
+    cached = page_cache.get(request.full_path)
+    if cached is None:
+        g.page_tags = tags
+        return None
+    body, mimetype, validators = cached
+    response = Response(body, mimetype=mimetype, headers=validators)
+    response.headers['X-Cache'] = 'HIT'
+    return response.make_conditional(request)
+
+
+@app.after_request
+def store_cached_page(response):
+    tags = g.pop('page_tags', None)
+    if tags and response.status_code == 200 and not session.modified:
+        validators = {name: response.headers[name]
+                      for name in ('ETag', 'Last-Modified', 'Cache-Control') if name in response.headers}
+        if response.is_streamed:
+            # 边发送边留一份，发完整页后再放进缓存；中途断开的不缓存
+            response.response = _tee_into_cache(response.response, request.full_path, response.mimetype,
+                                                validators, tags)
+        else:
+            body = response.get_data()
+            if len(body) <= app.config['PAGE_CACHE_MAX_ENTRY_BYTES']:
+                page_cache.set(request.full_path, (body, response.mimetype, validators), tags=tags, size=len(body))
+        response.headers['X-Cache'] = 'MISS'
+    return response
+
+
+def _tee_into_cache(chunks, key, mimetype, validators, tags):
+    limit = app.config['PAGE_CACHE_MAX_ENTRY_BYTES']
+    parts, size = [], 0
+    try:
+        for chunk in chunks:
+            if parts is not None:
+                part = chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+                size += len(part)
+                # 超过单页上限就放弃缓存，已经攒下的也丢掉，剩下的只管发送
+                if size <= limit:
+                    parts.append(part)
+                else:
+                    parts = None
+            yield chunk
+        if parts is not None:
+            body = b''.join(parts)
+            page_cache.set(key, (body, mimetype, validators), tags=tags, size=size)
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+
+def cache_stats():
+    """Return the stats of the page, comment fragment and markdown caches by name."""
+    return {'pages': page_cache.stats(), 'fragments': comment_fragments.stats(), 'markdown': markdown_cache.stats()}
+
+
+_cache_stats_logged_at = time.monotonic()
+
+
+@app.after_request
+def log_cache_stats(response):
+    # 命中次数只记在各个进程里，定期写进日志才看得到
+    global _cache_stats_logged_at
+    interval = app.config['CACHE_STATS_LOG_INTERVAL']
+    now = time.monotonic()
+    if interval and now - _cache_stats_logged_at >= interval:
+        _cache_stats_logged_at = now
+        for name, stats in cache_stats().items():
+            lookups = stats['hits'] + stats['misses']
+            app.logger.info('cache %s: hits=%d misses=%d hit_rate=%.1f%% entries=%d bytes=%d evictions=%d',
+                            name, stats['hits'], stats['misses'], 100.0 * stats['hits'] / lookups if lookups else 0,
+                            stats['entries'], stats['bytes'], stats['evictions'])
+    return response
+
+
+@app.cli.command('cache-stats')
+def cache_stats_command():
+    """Show how many entries and bytes each cache holds."""
+    backend = app.config['CACHE_BACKEND']
+    click.echo('Backend: %s' % backend)
+    # 命中率按进程统计，在服务端日志里（CACHE_STATS_LOG_INTERVAL）
+    if backend == 'memory':
+        click.echo('Memory caches live in each server process; see the server log for their stats.')
+        return
+    for name, stats in cache_stats().items():
+        click.echo('%-10s entries=%d bytes=%d' % (name, stats['entries'], stats['bytes']))
+
+
+def load_project_page(kind, project_id):
+    """Load a project and the (etag, last_modified) of its view/comments page, or 404."""
+    project = db.session.get(Projects, project_id)
+    if project is None:
+        abort(404)
+    owner = owner_cache.get()
+    if kind == 'comments':
+        last_modified, state = project.comments_updated_at, (project.comments_updated_at, project.comment_count)
+    else:
+        last_modified, state = project.updated_at, (project.updated_at,)
+    # 登录与否页面内容不同，也要算进 ETag
+    parts = [kind, project_id, owner and owner.version, session.get('_user_id')] + [str(value) for value in state]
+    return project, make_validators(parts, last_modified)
+
+
+def make_validators(parts, last_modified):
+    """Build the (etag, last_modified) pair for a response from the values its content depends on."""
+    etag = hashlib.sha1(json.dumps(parts).encode('utf-8')).hexdigest()
+    if last_modified is not None:
+        last_modified = last_modified.replace(tzinfo=timezone.utc, microsecond=0)
+    return etag, last_modified
+
+
+def not_modified(validators):
+    """Return a 304 response if the client's cached copy is still current, otherwise None."""
+    if validators is None or request.method not in ('GET', 'HEAD') or '_flashes' in session:
+        return None
+    etag, last_modified = validators
+    if request.if_none_match:
+        # 弱比较：经 gzip 中间件压缩的响应带的是 W/ 弱 ETag
+        fresh = request.if_none_match.contains_weak(etag)
+    else:
+        fresh = (request.if_modified_since is not None and last_modified is not None
+                 and last_modified <= request.if_modified_since)
+    if not fresh:
+        return None
+    return with_validators(Response(status=304), validators)
+
+
+def with_validators(response, validators):
+    response = make_response(response)
+    if validators is not None and response.status_code in (200, 304):
+        etag, last_modified = validators
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.cache_control.no_cache = True   # 浏览器每次都回来验证，命中时只回 304
+    return response
 
 
 @app.route('/',methods = ['GET','POST'])
@@ -162,13 +1379,48 @@ def index():
             return redirect(url_for('index'))
         title = request.form.get('title')
         if title:
-            new_project = Projects(title = title , content = '')
+            new_project = Projects(title = title , content = '', source = '')
             db.session.add(new_project)
             db.session.commit()
+            invalidate_pages('index')
             flash('Add successfully.')
-            
-    projects = Projects.query.all()
-    return render_template('index.html', projects=projects)
+
+    after = request.args.get('after', type=int)
+    before = request.args.get('before', type=int)
+    projects, prev_cursor, next_cursor = paginate_projects(after=after, before=before)
+    total = db.session.scalar(db.select(db.func.count(Projects.id)))
+    return render_template('index.html', projects=projects, total=total,
+                           prev_cursor=prev_cursor, next_cursor=next_cursor)
+
+
+def paginate_projects(after=None, before=None, per_page=None):
+    """Return one keyset page of (id, title) rows plus the prev/next cursors."""
+    per_page = per_page or app.config['PROJECTS_PER_PAGE']
+    # 只取 id/title 两列，不加载 content，按主键索引做游标翻页，开销与表大小无关
+    query = db.select(Projects.id, Projects.title, Projects.comment_count)
+    if before is not None:
+        query = query.where(Projects.id < before).order_by(Projects.id.desc())
+    else:
+        if after is not None:
+            query = query.where(Projects.id > after)
+        query = query.order_by(Projects.id)
+    rows = db.session.execute(query.limit(per_page + 1)).all()
+
+    # 多取一条用来判断这一方向上是否还有下一页
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if before is not None:
+        rows.reverse()
+    if not rows:
+        return rows, None, None
+
+    if before is not None:
+        prev_cursor = rows[0].id if has_more else None
+        next_cursor = rows[-1].id
+    else:
+        prev_cursor = rows[0].id if after is not None else None
+        next_cursor = rows[-1].id if has_more else None
+    return rows, prev_cursor, next_cursor
 
 
 @app.errorhandler(404)
@@ -176,6 +1428,14 @@ def page_not_found(e):
     return render_template('404.html'), 404
 
 
+@app.route('/search')
+def search():
+    q = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    results, has_next = search_content(q, page=page) if q else ([], False)
+    return render_template('search.html', q=q, results=results, page=page, has_next=has_next)
+
+
 @app.route('/edit/<int:project_id>', methods=['GET', 'POST'])
 @login_required
 def edit_project(project_id):
@@ -184,8 +1444,12 @@ def edit_project(project_id):
     if request.method == 'POST':
         content = request.form['content']
 
-        project.content = Markup(markdown2.markdown(content))
+        # 原文和渲染结果分开存，编辑页面显示的是 markdown 原文
+        project.source = content
+        project.content, project.rendered_with = render_markdown(content)
+        project.updated_at = datetime.utcnow()
         db.session.commit()
+        invalidate_pages('project:%d' % project.id, 'api:projects')
         flash('updated successfully')
         return redirect(url_for('index'))
 
@@ -194,32 +1458,44 @@ def edit_project(project_id):
 
 @app.route('/view/<int:project_id>')
 def view_project(project_id):
-    project = Projects.query.get_or_404(project_id)
-    return render_template('view_project.html', project=project)
+    project, validators = load_project_page('view', project_id)
+    response = not_modified(validators)
+    if response is not None:
+        return response
+    return with_validators(render_template('view_project.html', project=project), validators)
 
 @app.route('/movie/delete/<int:project_id>', methods=['POST'])  # 限定只接受 POST 请求
 @login_required
 def delete(project_id):
     project = Projects.query.get_or_404(project_id)  
+    # 评论和回复随项目一起删掉，避免留下孤儿评论
+    thread = db.select(Comment.id).where(Comment.project_id == project.id)
+    db.session.execute(db.delete(AdminReply).where(AdminReply.comment_id.in_(thread)))
+    db.session.execute(db.delete(Comment).where(Comment.project_id == project.id))
     db.session.delete(project)  # 删除对应的记录
     db.session.commit()  # 提交数据库会话
+    invalidate_pages('index', 'project:%d' % project_id, 'comments:%d' % project_id)
+    comment_fragments.invalidate('comments:%d' % project_id)
     flash('deleted.')
     return redirect(url_for('index'))  # 重定向回主页
 
 @app.route('/comments/<int:project_id>', methods=['GET', 'POST'])
 def comments(project_id):
-    project = Projects.query.get_or_404(project_id)
-
     if request.method == 'POST':
-        # 获取用户的IP地址
-        user_ip = request.remote_addr
+        # 限流放在最前面，被拒绝的请求不碰数据库
+        retry_after = comment_rate_limit()
+        if retry_after:
+            return Response('评论太频繁，请稍后再试。\n', status=429, mimetype='text/plain',
+                            headers={'Retry-After': str(retry_after)})
 
-        # 检查用户是否在短时间内发表过评论
-        #last_comment_time = session.get('last_comment_time', None)
-        #if last_comment_time and datetime.utcnow() - last_comment_time.replace(tzinfo=None) < timedelta(minutes=5):
-        #flash('评论太频繁，请稍后再试。')
-        #return redirect(url_for('comments', project_id=project.id))
+    project, validators = load_project_page('comments', project_id)
+    if request.method == 'GET':
+        # 在加载评论和渲染模板之前先判断能不能直接回 304
+        response = not_modified(validators)
+        if response is not None:
+            return response
 
+    if request.method == 'POST':
         # 处理评论逻辑
         author = request.form.get('author')
         content = request.form.get('content')
@@ -229,28 +1505,261 @@ def comments(project_id):
             flash('评论内容过长，请缩短评论。')
             return redirect(url_for('comments', project_id=project.id))
 
-        # 过滤恶意内容
-        if contains_malicious_content(content):
+        # 过滤恶意内容；开启审核时交给后台打分，请求里只做最便宜的检查
+        moderated = app.config['MODERATION_ENABLED']
+        if not moderated and contains_malicious_content(content):
             flash('评论包含恶意内容，请修改评论。')
             return redirect(url_for('comments', project_id=project.id))
 
         if author and content:
-            new_comment = Comment(author=author, content=content, project=project)
-            db.session.add(new_comment)
-            db.session.commit()
+            status = 'pending' if moderated else 'published'
+            if app.config['WRITE_QUEUE_ENABLED']:
+                comment_id = queued_insert(Comment, author=author, content=content, project_id=project.id,
+                                           status=status)
+            else:
+                new_comment = Comment(author=author, content=content, project=project, status=status)
+                db.session.add(new_comment)
+                db.session.commit()
+                comment_id = new_comment.id
+
+            if comment_id is None:
+                # 写队列超时：评论还在排队，不能确认已保存；待审核的留给 flask moderate 处理
+                flash('评论提交较慢，请稍后刷新页面查看。')
+            elif moderated:
+                moderation_pool().submit(comment_id)
+                flash('评论已提交，审核通过后显示。')
+            else:
+                invalidate_pages('comments:%d' % project.id, 'index')   # 首页显示评论数
+
+    if request.method == 'GET' and (request.args.get('stream') == '1'
+                                    or project.comment_count > app.config['COMMENTS_STREAM_THRESHOLD']):
+        # 长讨论串：页头和前几条评论先发出去，内存只跟一批评论的大小有关
+        pieces = stream_template('comments.html', project=project, blocks=iter_comment_blocks(project))
+        return with_validators(Response(coalesce_chunks(pieces), mimetype='text/html'), validators)
+
+    blocks = list(iter_comment_blocks(project))
+    page = render_template('comments.html', project=project, blocks=blocks)
+    if request.method == 'GET':
+        return with_validators(page, validators)
+    return page
+
+
+comment_fragments = make_cache('fragments', max_entries=app.config['COMMENT_FRAGMENT_MAX_ENTRIES'],
+                               max_bytes=app.config['COMMENT_FRAGMENT_MAX_BYTES'])
+
+
+def load_replies(comment_ids):
+    """Map comment id -> admin replies for the given comments, in one query."""
+    reply_query = AdminReply.query.filter(AdminReply.comment_id.in_(comment_ids)).order_by(AdminReply.id)
+    replies = {}
+    for reply in reply_query:
+        replies.setdefault(reply.comment_id, []).append(reply)
+    return replies
+
+
+def iter_comment_blocks(project, chunk_size=None):
+    """Yield every comment of a project rendered through comment_block.html, one cursor batch at a time."""
+    chunk_size = chunk_size or app.config['COMMENT_CHUNK_SIZE']
+    # 两个关系都是 lazy='dynamic'，模板里逐条访问会变成 2 + N 次查询；
+    # 这里按批从游标取评论，每批的回复用一次 IN 查询取齐（批大小远小于 SQLite 参数上限），
+    # 整页是 项目 + 评论 + ceil(N / chunk_size) 次回复查询。不按项目一次取齐所有回复，
+    # 是为了流式输出的长讨论串内存只跟一批有关；不走流式的页面评论数不超过一批，仍是 3 次
+    columns = Comment.__table__.c
+    rows = db.session.execute(
+        db.select(columns.id, columns.author, columns.content, columns.timestamp, columns.reply_count)
+        .where(columns.project_id == project.id, columns.status == 'published')
+        .order_by(columns.id)
+        .execution_options(yield_per=chunk_size))
+    template = app.jinja_env.get_template('comment_block.html')
+    for batch in rows.partitions():
+        # 评论内容不会再改，回复数就是片段的版本号，新回复会让这一条重新渲染；
+        # 带上时间戳，防止 SQLite 复用被删掉的 id 时拿到旧片段
+        keys = [(comment.id, comment.reply_count, comment.timestamp) for comment in batch]
+        blocks = [comment_fragments.get(key) for key in keys]
+        missing = [comment.id for comment, block in zip(batch, blocks) if block is None]
+        replies = load_replies(missing) if missing else {}
+        for i, comment in enumerate(batch):
+            if blocks[i] is None:
+                blocks[i] = Markup(template.render(comment=comment, replies=replies.get(comment.id, ())))
+                comment_fragments.set(keys[i], blocks[i], tags=('comments:%d' % project.id,),
+                                      size=len(blocks[i]))
+        yield from blocks
+
+
+def coalesce_chunks(pieces, first_size=1024, size=None):
+    """Join the many small strings a streamed template yields into network-sized chunks.
 
-            # 更新最后评论时间
-            session['last_comment_time'] = datetime.utcnow()
+    The first chunk is flushed after ``first_size`` characters so the page header goes out at once.
+    """
+    size = size or app.config['STREAM_FLUSH_BYTES']
+    buffered, length, limit = [], 0, first_size
+    for piece in pieces:
+        buffered.append(piece)
+        length += len(piece)
+        if length >= limit:
+            yield ''.join(buffered)
+            buffered, length, limit = [], 0, size
+    if buffered:
+        yield ''.join(buffered)
+
+
+comment_limiter = SlidingWindowLimiter(app.config['COMMENT_RATE_LIMIT'], app.config['COMMENT_RATE_WINDOW'])
+
+
+def client_ip():
+    """Client address, taken from the configured proxy headers when present."""
+    for name in app.config['RATE_LIMIT_PROXY_HEADERS']:
+        value = request.headers.get(name)
+        if value:
+            # 最左边的地址客户端可以随便伪造，只信任可信代理追加的那一个
+            addresses = [address.strip() for address in value.split(',') if address.strip()]
+            if addresses:
+                return addresses[-min(app.config['RATE_LIMIT_PROXY_COUNT'], len(addresses))]
+    return request.remote_addr
+
+
+def comment_rate_limit():
+    """Count this comment against its IP and author; return seconds to wait, or 0 if allowed."""
+    keys = ['ip:%s' % client_ip()]
+    author = (request.form.get('author') or '').strip().casefold()
+    if author:
+        keys.append('author:%s' % author)
+    # 所有键都放行才一起计数，被 IP 拦下的请求不会占用这个署名的额度，反之亦然
+    return comment_limiter.hit_all(keys)
+
+
+def load_blocklist():
+    try:
+        with open(app.config['BLOCKLIST_PATH'], encoding='utf-8') as f:
+            return Blocklist(f)
+    except FileNotFoundError:
+        return Blocklist()
+
+
+# 词表文件本身就是标记文件：文件一改（inode/mtime 变化），各进程下次检查时重新编译
+blocklist = SharedValueCache(load_blocklist, app.config['BLOCKLIST_PATH'])
 
-    return render_template('comments.html', project=project)
 
 def contains_malicious_content(content):
-    # 使用正则表达式或其他方法检查是否包含恶意内容
-    malicious_patterns = ['badword1', 'badword2', 'maliciouslink.com']
-    for pattern in malicious_patterns:
-        if re.search(pattern, content, re.IGNORECASE):
-            return True
-    return False
+    # 一次扫描同时匹配所有词，耗时只和评论长度有关，与词表大小无关
+    return blocklist.get().match(content) is not None
+
+
+LINK_RE = re.compile(r'https?://|www\.', re.IGNORECASE)
+
+
+def comment_verdict(comment, seen):
+    """Return 'published' or 'rejected' for one pending comment row.
+
+    ``seen`` maps (project_id, author, content) to the time it was last published, including
+    earlier comments of the same batch; the same author repeating a comment on the same
+    project within MODERATION_DUPLICATE_WINDOW is rejected as a duplicate.
+    """
+    if contains_malicious_content(comment.content) or contains_malicious_content(comment.author):
+        return 'rejected'
+    if len(LINK_RE.findall(comment.content)) > app.config['MODERATION_MAX_LINKS']:
+        return 'rejected'
+    key = (comment.project_id, comment.author, comment.content)
+    last = seen.get(key)
+    if last is not None and comment.timestamp - last <= timedelta(seconds=app.config['MODERATION_DUPLICATE_WINDOW']):
+        return 'rejected'
+    seen[key] = comment.timestamp
+    return 'published'
+
+
+def moderate_comments(comment_ids):
+    """Score a batch of pending comments and publish or reject them in one transaction."""
+    comments = Comment.__table__
+    with app.app_context():
+        rows = db.session.execute(
+            db.select(comments.c.id, comments.c.project_id, comments.c.author, comments.c.content,
+                      comments.c.timestamp)
+            .where(comments.c.id.in_(comment_ids), comments.c.status == 'pending')
+        ).all()
+        if not rows:
+            return {}
+        db.session.remove()
+
+        published = Counter()
+        # 判重要看到其他批次刚发布的评论：写连接只有一个，各批次在这里排队，前一批提交后才轮到下一批
+        with db.engine.begin() as conn:
+            # 时间窗内同一作者已发布的同内容评论一次查出来
+            since = min(row.timestamp for row in rows) - timedelta(seconds=app.config['MODERATION_DUPLICATE_WINDOW'])
+            published_rows = conn.execute(
+                db.select(comments.c.project_id, comments.c.author, comments.c.content, comments.c.timestamp)
+                .where(comments.c.project_id.in_({row.project_id for row in rows}),
+                       comments.c.author.in_({row.author for row in rows}),
+                       comments.c.content.in_({row.content for row in rows}),
+                       comments.c.status == 'published', comments.c.timestamp >= since)
+                .order_by(comments.c.timestamp)
+            ).tuples()
+            seen = {(project_id, author, content): timestamp
+                    for project_id, author, content, timestamp in published_rows}
+            verdicts = {row.id: comment_verdict(row, seen) for row in sorted(rows, key=lambda row: row.id)}
+            for status in ('published', 'rejected'):
+                ids = [comment_id for comment_id, verdict in verdicts.items() if verdict == status]
+                if not ids:
+                    continue
+                # 只改仍是 pending 的行，重复投递或期间被删掉的评论不受影响
+                project_ids = conn.execute(
+                    db.update(comments).where(comments.c.id.in_(ids), comments.c.status == 'pending')
+                    .values(status=status).returning(comments.c.project_id)).scalars().all()
+                if status == 'published':
+                    published.update(project_ids)
+            for project_id, count in published.items():
+                _bump_counter(conn, Projects.__table__, 'comment_count', project_id, count)
+                _touch_comments(conn, project_id=project_id)
+
+        # 新发布的评论还没有渲染过片段，只需让整页缓存失效
+        for project_id in published:
+            invalidate_pages('comments:%d' % project_id, 'index')
+        return verdicts
+
+
+_moderation_pool = None
+_moderation_pool_lock = threading.Lock()
+
+
+def moderation_pool():
+    global _moderation_pool
+    with _moderation_pool_lock:
+        if _moderation_pool is None or _moderation_pool[0] != os.getpid():
+            _moderation_pool = (os.getpid(), BatchWorkerPool(
+                moderate_comments,
+                workers=app.config['MODERATION_WORKERS'],
+                batch_size=app.config['MODERATION_BATCH_SIZE'],
+                max_delay=app.config['MODERATION_MAX_DELAY'],
+                name='moderation',
+            ))
+        return _moderation_pool[1]
+
+
+@atexit.register
+def close_moderation_pool():
+    global _moderation_pool
+    with _moderation_pool_lock:
+        if _moderation_pool is not None and _moderation_pool[0] == os.getpid():
+            _moderation_pool[1].close()
+        _moderation_pool = None
+
+
+@app.cli.command()
+def moderate():
+    """Score every pending comment, e.g. the ones left over from before a restart."""
+    comments = Comment.__table__
+    published = rejected = 0
+    while True:
+        ids = db.session.execute(
+            db.select(comments.c.id).where(comments.c.status == 'pending')
+            .order_by(comments.c.id).limit(app.config['MODERATION_BATCH_SIZE'])
+        ).scalars().all()
+        db.session.remove()
+        if not ids:
+            break
+        verdicts = list(moderate_comments(ids).values())
+        published += verdicts.count('published')
+        rejected += verdicts.count('rejected')
+    click.echo('Published %d, rejected %d.' % (published, rejected))
 
 @app.route('/admin_reply/<int:comment_id>', methods=['POST'])
 @login_required
@@ -261,11 +1770,153 @@ def admin_reply(comment_id):
         admin_reply_content = request.form['admin_reply']
 
         # 创建管理员回复
-        admin_reply = AdminReply(content=admin_reply_content, comment=comment)
-        db.session.add(admin_reply)
-        db.session.commit()
+        if app.config['WRITE_QUEUE_ENABLED']:
+            reply_id = queued_insert(AdminReply, content=admin_reply_content, comment_id=comment.id)
+        else:
+            admin_reply = AdminReply(content=admin_reply_content, comment=comment)
+            db.session.add(admin_reply)
+            db.session.commit()
+            reply_id = admin_reply.id
+        invalidate_pages('comments:%d' % comment.project_id)
 
-        flash('Admin reply added.')
+        flash('Admin reply added.' if reply_id is not None else 'Admin reply is still being saved.')
 
     return redirect(url_for('comments', project_id=comment.project.id))
 
+
+@app.route('/export')
+@login_required
+def export():
+    model_names = [name for name in request.args.getlist('model') if name in EXPORT_MODELS] or list(EXPORT_MODELS)
+    compress = request.args.get('gzip') == '1'
+    filename = 'watchlist-export.jsonl' + ('.gz' if compress else '')
+    # 边查边发，分块传输，内存占用与数据量无关
+    return Response(
+        stream_with_context(export_chunks(model_names, compress=compress)),
+        mimetype='application/gzip' if compress else 'application/x-ndjson',
+        headers={'Content-Disposition': 'attachment; filename=%s' % filename},
+    )
+
+
+# JSON 接口可返回的字段，以及不带 fields= 时的默认字段；id 总会返回，用作翻页游标
+API_FIELDS = {
+    'project': ('id', 'title', 'content', 'source', 'comment_count', 'updated_at', 'comments_updated_at'),
+    'comment': ('id', 'project_id', 'author', 'content', 'timestamp', 'reply_count'),
+}
+API_LIST_FIELDS = ('id', 'title', 'comment_count', 'updated_at')
+
+
+def api_response(payload, status=200):
+    body = json.dumps(payload, default=_json_default, ensure_ascii=False, separators=(',', ':'))
+    return Response(body, status=status, mimetype='application/json')
+
+
+def api_error(status, message):
+    abort(api_response({'error': message}, status))
+
+
+def api_fields(kind, default):
+    """Return the requested field names (id first) and their columns, or abort with 400."""
+    requested = request.args.get('fields')
+    names = default if requested is None else [name.strip() for name in requested.split(',') if name.strip()]
+    unknown = [name for name in names if name not in API_FIELDS[kind]]
+    if unknown:
+        api_error(400, 'unknown fields: %s' % ', '.join(unknown))
+    names = ['id'] + [name for name in dict.fromkeys(names) if name != 'id']
+    table = (Projects if kind == 'project' else Comment).__table__
+    return names, [table.c[name] for name in names]
+
+
+def api_page(query, id_column):
+    """Run one keyset page of ``query`` after the ?after= cursor; return (rows, next_cursor)."""
+    limit = request.args.get('limit', app.config['API_PAGE_SIZE'], type=int)
+    limit = min(max(limit, 1), app.config['API_MAX_PAGE_SIZE'])
+    after = request.args.get('after', type=int)
+    if after is not None:
+        query = query.where(id_column > after)
+    # 多取一条判断是否还有下一页
+    rows = db.session.execute(query.order_by(id_column).limit(limit + 1)).all()
+    next_cursor = rows[limit - 1].id if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+@app.route('/api/projects')
+def api_projects():
+    names, columns = api_fields('project', API_LIST_FIELDS)
+    rows, next_cursor = api_page(db.select(*columns), Projects.id)
+    response = api_response({'items': [dict(zip(names, row)) for row in rows], 'next': next_cursor})
+    # 列表没有现成的版本号，用内容摘要做 ETag，至少省掉重复传输
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+@app.route('/api/projects/batch', methods=['GET', 'POST'])
+def api_projects_batch():
+    # GET ?ids=1,2,3 或 POST {"ids": [1, 2, 3]}，字段选择和列表接口一样
+    if request.method == 'POST':
+        payload = request.get_json(silent=True)
+        if not isinstance(payload, dict) or not isinstance(payload.get('ids'), list):
+            api_error(400, 'body must be a JSON object with an "ids" list')
+        ids = payload['ids']
+        # JSON 里只接受整数，true/false 和 "12" 这样的字符串都不算
+        if not all(isinstance(project_id, int) and not isinstance(project_id, bool) for project_id in ids):
+            api_error(400, 'ids must be integers')
+    else:
+        try:
+            ids = [int(project_id) for project_id in request.args.get('ids', '').split(',') if project_id.strip()]
+        except ValueError:
+            api_error(400, 'ids must be integers')
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        api_error(400, 'no ids given')
+    if len(ids) > app.config['API_BATCH_MAX_IDS']:
+        api_error(400, 'at most %d ids per request' % app.config['API_BATCH_MAX_IDS'])
+    names, columns = api_fields('project', API_LIST_FIELDS)
+
+    # 一次 IN 查询取回全部，按请求的顺序返回，查不到的 id 单独列出
+    rows = db.session.execute(db.select(*columns).where(Projects.id.in_(ids))).all()
+    found = {row.id: dict(zip(names, row)) for row in rows}
+    response = api_response({'items': [found[project_id] for project_id in ids if project_id in found],
+                             'missing': [project_id for project_id in ids if project_id not in found]})
+    if request.method == 'GET':
+        response.add_etag()
+        response = response.make_conditional(request)
+    return response
+
+
+@app.route('/api/projects/<int:project_id>')
+def api_project(project_id):
+    names, columns = api_fields('project', API_FIELDS['project'])
+    state = (Projects.updated_at, Projects.comments_updated_at, Projects.comment_count)
+    row = db.session.execute(db.select(*columns, *state).where(Projects.id == project_id)).first()
+    if row is None:
+        api_error(404, 'project %d not found' % project_id)
+    updated_at, comments_updated_at, comment_count = row[len(names):]
+    validators = make_validators(['api:project', project_id, str(updated_at), str(comments_updated_at),
+                                  comment_count, names],
+                                 max(filter(None, (updated_at, comments_updated_at)), default=None))
+    response = not_modified(validators)
+    if response is not None:
+        return response
+    return with_validators(api_response(dict(zip(names, row))), validators)
+
+
+@app.route('/api/projects/<int:project_id>/comments')
+def api_comments(project_id):
+    project = db.session.execute(
+        db.select(Projects.comments_updated_at, Projects.comment_count).where(Projects.id == project_id)).first()
+    if project is None:
+        api_error(404, 'project %d not found' % project_id)
+    names, columns = api_fields('comment', API_FIELDS['comment'])
+    # 游标和字段不同，返回的内容就不同，都要算进 ETag
+    validators = make_validators(['api:comments', project_id, str(project.comments_updated_at),
+                                  project.comment_count, names, request.args.get('after'), request.args.get('limit')],
+                                 project.comments_updated_at)
+    response = not_modified(validators)
+    if response is not None:
+        return response
+    rows, next_cursor = api_page(
+        db.select(*columns).where(Comment.project_id == project_id, Comment.status == 'published'), Comment.id)
+    payload = {'items': [dict(zip(names, row)) for row in rows], 'next': next_cursor}
+    return with_validators(api_response(payload), validators)
+
@@ -0,0 +1,48 @@
+"""Time Blocklist.match() against blocklists of growing size.
+
+Run ``python bench_blocklist.py``; the old per-pattern ``re.search`` loop is timed alongside
+for comparison up to 10,000 entries.
+"""
+import random
+import re
+import string
+import time
+
+from blocklist import Blocklist
+
+
+def random_word(rng, length):
+    return ''.join(rng.choice(string.ascii_lowercase) for _ in range(length))
+
+
+def per_pattern_search(patterns, text):
+    # 原来 contains_malicious_content 的做法
+    return any(re.search(pattern, text, re.IGNORECASE) for pattern in patterns)
+
+
+def timed(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def main():
+    rng = random.Random(0)
+    comment = ' '.join(random_word(rng, rng.randint(3, 9)) for _ in range(70))
+    comment += ' more at https://www.Example.org/page?id=1'
+    print('comment length: %d characters' % len(comment))
+    print('%8s %10s %12s %16s' % ('entries', 'build ms', 'match us', 're.search us'))
+    for size in (10, 100, 1000, 10000, 50000):
+        entries = [random_word(rng, rng.randint(6, 12)) for _ in range(size // 2)]
+        entries += ['%s.%s' % (random_word(rng, 8), rng.choice(('com', 'net', 'info'))) for _ in range(size - size // 2)]
+        start = time.perf_counter()
+        blocklist = Blocklist(entries)
+        build = (time.perf_counter() - start) * 1000
+        match = timed(lambda: blocklist.match(comment), 200)
+        old = '%16.1f' % timed(lambda: per_pattern_search(entries, comment), 5) if size <= 10000 else '%16s' % '-'
+        print('%8d %10.1f %12.1f %s' % (size, build, match, old))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+import re
+import unicodedata
+from collections import deque
+
+_HOST = r'(?:[a-z0-9](?:[a-z0-9-]*[a-z0-9])?\.)+[a-z][a-z0-9-]*[a-z0-9]'
+_HOST_RE = re.compile(_HOST)
+# 词表里写成网址或域名的条目按域名处理，例如 https://www.evil.example/path -> evil.example
+_DOMAIN_TERM_RE = re.compile(r'(?:[a-z][a-z0-9+.-]*://)?(?:www\.)?(%s)\.?(?:[:/?#]\S*)?' % _HOST)
+# 常见的域名混淆写法：evil[.]example、evil(dot)example
+_OBFUSCATED_DOT_RE = re.compile(r'\s*[\[({]\s*(?:\.|dot)\s*[\])}]\s*')
+_INVISIBLE_RE = re.compile('[\u00ad\u200b-\u200f\u2060\ufeff]')
+_SPACE_RE = re.compile(r'\s+')
+
+
+def normalize_text(text):
+    """Casefold and NFKC-normalize text, drop invisible characters and undo dot obfuscation."""
+    text = unicodedata.normalize('NFKC', text).casefold()
+    text = _INVISIBLE_RE.sub('', text)
+    text = _OBFUSCATED_DOT_RE.sub('.', text)
+    return _SPACE_RE.sub(' ', text)
+
+
+class Blocklist:
+    """Match text against many blocked terms and domains in one pass.
+
+    Terms are found anywhere in the normalized text with an Aho-Corasick automaton, so the
+    cost of ``match()`` depends on the length of the text, not on the number of terms.
+    Domains match the host of any URL or bare domain in the text, including subdomains.
+    """
+
+    def __init__(self, entries=()):
+        self.terms = set()
+        self.domains = set()
+        for entry in entries:
+            entry = normalize_text(entry).strip()
+            if not entry or entry.startswith('#'):
+                continue
+            domain = _DOMAIN_TERM_RE.fullmatch(entry)
+            if domain:
+                self.domains.add(domain.group(1))
+            else:
+                self.terms.add(entry)
+        self._goto, self._fail, self._out = _build_automaton(self.terms)
+
+    def __len__(self):
+        return len(self.terms) + len(self.domains)
+
+    def match(self, text):
+        """Return the first blocked term or domain found in ``text``, or None."""
+        text = normalize_text(text)
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if out[node] is not None:
+                return out[node]
+        if self.domains:
+            for host in _HOST_RE.findall(text):
+                labels = host.split('.')
+                # a.b.evil.example 依次查 a.b.evil.example、b.evil.example、evil.example
+                for i in range(len(labels) - 1):
+                    domain = '.'.join(labels[i:])
+                    if domain in self.domains:
+                        return domain
+        return None
+
+
+def _build_automaton(terms):
+    goto, out = [{}], [None]
+    for term in terms:
+        node = 0
+        for char in term:
+            child = goto[node].get(char)
+            if child is None:
+                child = goto[node][char] = len(goto)
+                goto.append({})
+                out.append(None)
+            node = child
+        out[node] = term
+
+    # 按层次遍历补上失配指针，并把后缀上能命中的词合并到每个结点
+    fail = [0] * len(goto)
+    queue = deque(goto[0].values())
+    while queue:
+        node = queue.popleft()
+        for char, child in goto[node].items():
+            state = fail[node]
+            while state and char not in goto[state]:
+                state = fail[state]
+            fail[child] = goto[state].get(char, 0)
+            if out[child] is None:
+                out[child] = out[fail[child]]
+            queue.append(child)
+    return goto, fail, out
@@ -0,0 +1,401 @@
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Thread-safe in-process LRU cache bounded by entry count and total size.
+
+    Every entry can carry tags; ``invalidate(*tags)`` drops all entries with any of them.
+    Entries older than ``ttl`` seconds (per ``set()``, else ``default_ttl``) are treated as missing.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=None, default_ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self._entries = OrderedDict()   # key -> (value, tags, size, expires)
+        self._tags = {}                 # tag -> set(keys)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and _expired(entry[3]):
+                self._discard(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, tags=(), size=0, ttl=None):
+        expires = _expires_at(self.default_ttl if ttl is None else ttl)
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (value, frozenset(tags), size, expires)
+            self._bytes += size
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            # 超出条数或字节上限时从最久未用的一端淘汰
+            while self._entries and (len(self._entries) > self.max_entries
+                                     or (self.max_bytes is not None and self._bytes > self.max_bytes)):
+                self._discard(next(iter(self._entries)))
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._discard(key)
+
+    def invalidate(self, *tags):
+        with self._lock:
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._entries), 'bytes': self._bytes}
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        _, tags, size, _ = entry
+        self._bytes -= size
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+class FileSystemCache:
+    """Cache shared by every process on the host, one pickle file per entry under ``directory``.
+
+    Tags are versioned: each tag has a small file holding a random token, ``invalidate()``
+    replaces the token, and entries written under an older token read as misses. Hit and
+    miss counters are per process; ``entries`` and ``bytes`` cover the whole directory.
+    """
+
+    prune_interval = 128    # 每写这么多次检查一次上限，避免每次 set 都扫目录
+
+    def __init__(self, directory, max_entries=1024, max_bytes=None, default_ttl=None):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self._entry_dir = os.path.join(directory, 'entries')
+        self._tag_dir = os.path.join(directory, 'tags')
+        os.makedirs(self._entry_dir, exist_ok=True)
+        os.makedirs(self._tag_dir, exist_ok=True)
+        self._writes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, default=None):
+        path = self._entry_path(key)
+        try:
+            with open(path, 'rb') as f:
+                expires, tag_tokens, value = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return default
+        if _expired(expires) or any(self._tag_token(tag) != token for tag, token in tag_tokens.items()):
+            _unlink(path)
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def set(self, key, value, tags=(), size=0, ttl=None):
+        expires = _expires_at(self.default_ttl if ttl is None else ttl)
+        tag_tokens = {tag: self._tag_token(tag) for tag in tags}
+        _write_atomic(self._entry_path(key), pickle.dumps((expires, tag_tokens, value), pickle.HIGHEST_PROTOCOL))
+        self._writes += 1
+        if self._writes % self.prune_interval == 0:
+            self.prune()
+
+    def delete(self, key):
+        _unlink(self._entry_path(key))
+
+    def invalidate(self, *tags):
+        for tag in tags:
+            _write_atomic(self._tag_path(tag), uuid.uuid4().hex.encode('ascii'))
+
+    def clear(self):
+        for entry in os.scandir(self._entry_dir):
+            _unlink(entry.path)
+
+    def prune(self):
+        """Drop expired entries, then the oldest ones until both limits hold again."""
+        entries = []
+        for entry in os.scandir(self._entry_dir):
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+        entries.sort()
+        count, total = len(entries), sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if count <= self.max_entries and (self.max_bytes is None or total <= self.max_bytes):
+                break
+            _unlink(path)
+            count, total = count - 1, total - size
+            self.evictions += 1
+
+    def stats(self):
+        count = total = 0
+        for entry in os.scandir(self._entry_dir):
+            try:
+                total += entry.stat().st_size
+            except FileNotFoundError:
+                continue
+            count += 1
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': count, 'bytes': total}
+
+    def _entry_path(self, key):
+        return os.path.join(self._entry_dir, _digest(key))
+
+    def _tag_path(self, tag):
+        return os.path.join(self._tag_dir, _digest(tag))
+
+    def _tag_token(self, tag):
+        try:
+            with open(self._tag_path(tag), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return b''
+
+
+class SQLiteCache:
+    """Cache shared by every process on the host, stored in one SQLite file read through mmap.
+
+    Each thread (and each forked process) opens its own connection. Over the limits the
+    oldest written entries are evicted first. Hit and miss counters are per process.
+    """
+
+    prune_interval = 128
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS cache_entries ('
+        ' key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL,'
+        ' expires REAL, stored REAL NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS ix_cache_entries_stored ON cache_entries (stored)',
+        'CREATE TABLE IF NOT EXISTS cache_tags ('
+        ' tag TEXT NOT NULL, key TEXT NOT NULL, PRIMARY KEY (tag, key)) WITHOUT ROWID',
+        'CREATE INDEX IF NOT EXISTS ix_cache_tags_key ON cache_tags (key)',
+    )
+
+    def __init__(self, path, max_entries=1024, max_bytes=None, default_ttl=None, mmap_size=64 * 1024 * 1024):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.mmap_size = mmap_size
+        self._local = threading.local()
+        self._writes = 0
+        self.hits = self.misses = self.evictions = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as conn:
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+
+    def get(self, key, default=None):
+        digest = _digest(key)
+        conn = self._connect()
+        row = conn.execute('SELECT value, expires FROM cache_entries WHERE key = ?', (digest,)).fetchone()
+        if row is not None and _expired(row[1]):
+            with conn:
+                self._discard(conn, digest)
+            row = None
+        if row is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return pickle.loads(row[0])
+
+    def set(self, key, value, tags=(), size=0, ttl=None):
+        digest = _digest(key)
+        blob = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        expires = _expires_at(self.default_ttl if ttl is None else ttl)
+        conn = self._connect()
+        with conn:
+            self._discard(conn, digest)
+            conn.execute('INSERT INTO cache_entries (key, value, size, expires, stored) VALUES (?, ?, ?, ?, ?)',
+                         (digest, blob, len(blob), expires, time.time()))
+            conn.executemany('INSERT OR IGNORE INTO cache_tags (tag, key) VALUES (?, ?)',
+                             [(tag, digest) for tag in tags])
+        self._writes += 1
+        if self._writes % self.prune_interval == 0:
+            self.prune()
+
+    def delete(self, key):
+        conn = self._connect()
+        with conn:
+            self._discard(conn, _digest(key))
+
+    def invalidate(self, *tags):
+        if not tags:
+            return
+        marks = ', '.join('?' * len(tags))
+        conn = self._connect()
+        with conn:
+            conn.execute('DELETE FROM cache_entries WHERE key IN (SELECT key FROM cache_tags WHERE tag IN (%s))'
+                         % marks, tags)
+            conn.execute('DELETE FROM cache_tags WHERE key IN (SELECT key FROM cache_tags WHERE tag IN (%s))'
+                         % marks, tags)
+
+    def clear(self):
+        conn = self._connect()
+        with conn:
+            conn.execute('DELETE FROM cache_entries')
+            conn.execute('DELETE FROM cache_tags')
+
+    def prune(self):
+        """Drop expired entries, then the oldest ones until both limits hold again."""
+        conn = self._connect()
+        with conn:
+            conn.execute('DELETE FROM cache_tags WHERE key IN '
+                         '(SELECT key FROM cache_entries WHERE expires IS NOT NULL AND expires < ?)', (time.time(),))
+            conn.execute('DELETE FROM cache_entries WHERE expires IS NOT NULL AND expires < ?', (time.time(),))
+            count, total = conn.execute('SELECT count(*), coalesce(sum(size), 0) FROM cache_entries').fetchone()
+            if count <= self.max_entries and (self.max_bytes is None or total <= self.max_bytes):
+                return
+            for digest, size in conn.execute('SELECT key, size FROM cache_entries ORDER BY stored').fetchall():
+                if count <= self.max_entries and (self.max_bytes is None or total <= self.max_bytes):
+                    break
+                self._discard(conn, digest)
+                count, total = count - 1, total - size
+                self.evictions += 1
+
+    def stats(self):
+        count, total = self._connect().execute(
+            'SELECT count(*), coalesce(sum(size), 0) FROM cache_entries').fetchone()
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': count, 'bytes': total}
+
+    def _connect(self):
+        # 连接不能跨线程也不能跨 fork 复用，按 (线程, pid) 各开一条
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA mmap_size=%d' % self.mmap_size)
+            conn.isolation_level = ''   # 之后用 with conn: 包住的语句组成一个事务
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    @staticmethod
+    def _discard(conn, digest):
+        conn.execute('DELETE FROM cache_entries WHERE key = ?', (digest,))
+        conn.execute('DELETE FROM cache_tags WHERE key = ?', (digest,))
+
+
+BACKENDS = ('memory', 'filesystem', 'sqlite')
+
+
+def create_cache(backend, namespace, directory=None, **options):
+    """Build a cache for ``namespace`` on the named backend; options are the constructor's limits."""
+    if backend == 'memory':
+        return LRUCache(**options)
+    if backend == 'filesystem':
+        return FileSystemCache(os.path.join(directory, namespace), **options)
+    if backend == 'sqlite':
+        return SQLiteCache(os.path.join(directory, namespace + '.sqlite'), **options)
+    raise ValueError('unknown cache backend %r, expected one of %s' % (backend, ', '.join(BACKENDS)))
+
+
+def _digest(key):
+    # 键可以是元组、字节串等，repr 对这些类型是稳定的
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+
+def _expires_at(ttl):
+    return None if ttl is None else time.time() + ttl
+
+
+def _expired(expires):
+    return expires is not None and expires <= time.time()
+
+
+def _write_atomic(path, data):
+    tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+class SharedValueCache:
+    """Hold one value per process and reload it only after another writer bumps a marker file.
+
+    ``bump()`` atomically replaces the marker, so every process sees a new inode/mtime on its
+    next ``get()`` and calls ``loader`` again; in between, ``get()`` costs one ``os.stat``.
+    """
+
+    def __init__(self, loader, marker_path):
+        self.loader = loader
+        self.marker_path = marker_path
+        self.loads = 0
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._stamp = None
+        self._value = None
+
+    def get(self):
+        stamp = self._read_stamp()
+        with self._lock:
+            if self._loaded and stamp == self._stamp:
+                return self._value
+        # 先读标记再加载，加载期间如果又被改了，下次 get 会再刷新
+        value = self.loader()
+        with self._lock:
+            self._value, self._stamp, self._loaded = value, stamp, True
+            self.loads += 1
+        return value
+
+    def bump(self):
+        # 同一进程的多个线程也可能同时 bump，临时文件名要带上线程
+        tmp = '%s.%d.%d.tmp' % (self.marker_path, os.getpid(), threading.get_ident())
+        with open(tmp, 'w') as f:
+            f.write(str(time.time()))
+        os.replace(tmp, self.marker_path)
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._loaded = False
+            self._value = None
+
+    def _read_stamp(self):
+        try:
+            st = os.stat(self.marker_path)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns
@@ -0,0 +1,126 @@
+import zlib
+
+from werkzeug.http import parse_accept_header
+
+COMPRESSIBLE_TYPES = (
+    'text/',
+    'application/json',
+    'application/javascript',
+    'application/xml',
+    'application/x-ndjson',
+    'image/svg+xml',
+)
+
+
+class GzipMiddleware:
+    """WSGI middleware that gzips text responses chunk by chunk.
+
+    Bodies smaller than ``min_size`` are passed through untouched. Streamed bodies are
+    compressed as they are produced, with a sync flush after every chunk so nothing is
+    held back from the client. ``on_metrics(environ, bytes_in, bytes_out)`` is called
+    once per compressed response.
+    """
+
+    def __init__(self, app, min_size=500, level=6, on_metrics=None):
+        self.app = app
+        self.min_size = min_size
+        self.level = level
+        self.on_metrics = on_metrics
+        self.stats = {'responses': 0, 'bytes_in': 0, 'bytes_out': 0}
+
+    def __call__(self, environ, start_response):
+        accept = parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if environ.get('REQUEST_METHOD') == 'HEAD' or accept.quality('gzip') <= 0:
+            return self.app(environ, start_response)
+
+        captured = []
+
+        def capture(status, headers, exc_info=None):
+            captured[:] = [status, headers, exc_info]
+            # 不支持旧式的 write()，Flask 也不会用到
+            return lambda data: None
+
+        app_iter = self.app(environ, capture)
+        return self._respond(environ, app_iter, captured, start_response)
+
+    def _compressible(self, status, headers):
+        if int(status.split(' ', 1)[0]) in (204, 206, 304) or status.startswith('1'):
+            return False
+        headers = {name.lower(): value for name, value in headers}
+        if 'content-encoding' in headers or 'no-transform' in headers.get('cache-control', ''):
+            return False
+        content_length = headers.get('content-length')
+        if content_length is not None and int(content_length) < self.min_size:
+            return False
+        content_type = headers.get('content-type', '').split(';', 1)[0].strip()
+        return content_type.startswith(COMPRESSIBLE_TYPES)
+
+    def _respond(self, environ, app_iter, captured, start_response):
+        try:
+            chunks = iter(app_iter)
+            # 攒够 min_size 字节再决定压不压，太小的响应原样返回
+            buffered, size = [], 0
+            for chunk in chunks:
+                if not captured or not self._compressible(captured[0], captured[1]):
+                    buffered.append(chunk)
+                    break
+                buffered.append(chunk)
+                size += len(chunk)
+                if size >= self.min_size:
+                    break
+            status, headers, exc_info = captured
+            if size < self.min_size or not self._compressible(status, headers):
+                start_response(status, headers, exc_info)
+                yield from buffered
+                yield from chunks
+                return
+
+            start_response(status, self._gzip_headers(headers), exc_info)
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)    # 31 = gzip 格式
+            bytes_in = bytes_out = 0
+            for chunk in _chain(buffered, chunks):
+                if not chunk:
+                    continue
+                bytes_in += len(chunk)
+                data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+                bytes_out += len(data)
+                yield data
+            data = compressor.flush()
+            bytes_out += len(data)
+            yield data
+            self._record(environ, bytes_in, bytes_out)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+    def _gzip_headers(self, headers):
+        result = []
+        vary = []
+        for name, value in headers:
+            lower = name.lower()
+            if lower == 'content-length':
+                continue
+            if lower == 'vary':
+                vary.append(value)
+                continue
+            if lower == 'etag' and not value.startswith('W/'):
+                # 压缩后的字节和原文不同，强 ETag 改成弱 ETag，条件请求仍按弱比较命中
+                value = 'W/' + value
+            result.append((name, value))
+        if not any('accept-encoding' in value.lower() for value in vary):
+            vary.append('Accept-Encoding')
+        result.append(('Vary', ', '.join(vary)))
+        result.append(('Content-Encoding', 'gzip'))
+        return result
+
+    def _record(self, environ, bytes_in, bytes_out):
+        self.stats['responses'] += 1
+        self.stats['bytes_in'] += bytes_in
+        self.stats['bytes_out'] += bytes_out
+        if self.on_metrics is not None:
+            self.on_metrics(environ, bytes_in, bytes_out)
+
+
+def _chain(buffered, rest):
+    yield from buffered
+    yield from rest
@@ -0,0 +1,79 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+
+class SlidingWindowLimiter:
+    """Allow at most ``limit`` hits per key in any ``window`` seconds.
+
+    Uses the sliding-window counter approximation: each key keeps only the start and count
+    of its current fixed window plus the previous window's count, and the previous count is
+    weighted by how much of it still overlaps the sliding window. Keys idle for two windows
+    are dropped, so memory is O(1) per active key.
+    """
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self._keys = OrderedDict()  # key -> [window_start, count, previous_count]，按最近访问排序
+        self._lock = threading.Lock()
+
+    def hit(self, key, now=None):
+        """Record a hit for ``key``; return 0 if it is allowed, else seconds to wait before retrying."""
+        return self.hit_all((key,), now)
+
+    def hit_all(self, keys, now=None):
+        """Check every key and record a hit on all of them only if each one allows it.
+
+        Returns 0 when the hit was recorded, else the longest wait among the refusing keys.
+        A refused request does not use up the quota of any key.
+        """
+        now = time.monotonic() if now is None else now
+        start = now - now % self.window
+        elapsed = now - start
+        with self._lock:
+            self._expire(now)
+            states = [self._state(key, start) for key in keys]
+            wait = max((self._wait(state, elapsed) for state in states), default=0)
+            if wait:
+                return wait
+            for state in states:
+                state[1] += 1
+            return 0
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _state(self, key, start):
+        state = self._keys.get(key)
+        if state is None:
+            state = self._keys[key] = [start, 0, 0]
+        elif state[0] != start:
+            # 进入新窗口：紧挨着的上一窗口计数保留下来，更早的清零
+            state[2] = state[1] if start - state[0] == self.window else 0
+            state[0], state[1] = start, 0
+        self._keys.move_to_end(key)
+        return state
+
+    def _wait(self, state, elapsed):
+        previous, current = state[2], state[1]
+        if previous * (1 - elapsed / self.window) + current + 1 <= self.limit:
+            return 0
+        # 求 previous 的权重衰减到能再放行一次所需的时间；当前窗口本身已满时要等到下一个窗口
+        if current + 1 <= self.limit:
+            wait = self.window * (1 - (self.limit - current - 1) / previous) - elapsed
+        else:
+            wait = self.window - elapsed + self.window * (1 - (self.limit - 1) / current)
+        return max(1, math.ceil(wait))
+
+    def _expire(self, now):
+        while self._keys:
+            key, state = next(iter(self._keys.items()))
+            if now - state[0] < 2 * self.window:
+                break
+            del self._keys[key]
@@ -1,19 +1,60 @@
+import atexit
+import gzip
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
 import unittest
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from sqlalchemy import event
+from werkzeug.test import Client
+from jinja2 import ModuleLoader
+from gzip_middleware import GzipMiddleware
+from cache import create_cache
+
+# 在导入 app 之前指定临时数据库，测试不读写也不清空开发者的 data.db
+_database_dir = tempfile.mkdtemp()
+atexit.register(shutil.rmtree, _database_dir, ignore_errors=True)
+os.environ['DATABASE_FILE'] = os.path.join(_database_dir, 'test.db')
+
+import app as watchlist
 from app import app, db, User, Comment, Projects, AdminReply
 
 class ProjectsTestCase(unittest.TestCase):
 
     def setUp(self):
         app.config['TESTING'] = True
-        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
         self.client = app.test_client()
         self.runner = app.test_cli_runner()
 
     def tearDown(self):
+        watchlist.page_cache.clear()
+        watchlist.owner_cache.clear()
+        watchlist.comment_fragments.clear()
+        watchlist.comment_limiter.clear()
         with app.app_context():
             db.session.remove()
             db.drop_all()
 
+    @contextmanager
+    def count_queries(self):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        engines = list(db.engines.values())
+        for engine in engines:
+            event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            for engine in engines:
+                event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
     def login(self, username, password):
         return self.client.post('/login', data=dict(
             username=username,
@@ -80,6 +121,963 @@ class ProjectsTestCase(unittest.TestCase):
             self.assertIn(b'Add successfully', response.data)
             self.assertIn(b'New Title', response.data)
 
+    def test_index_pagination(self):
+        with app.app_context():
+            db.create_all()
+            user = User(username='TestUsername', name='Test User')
+            db.session.add(user)
+            db.session.add_all([Projects(title='Title %d' % i, content='') for i in range(25)])
+            db.session.commit()
+
+            app.config['PROJECTS_PER_PAGE'] = 10
+            try:
+                response = self.client.get('/')
+                data = response.get_data(as_text=True)
+                self.assertIn('25 Titles', data)
+                self.assertIn('Title 0', data)
+                self.assertNotIn('Title 10', data)
+                self.assertIn('after=10', data)
+                self.assertNotIn('before=', data)
+
+                data = self.client.get('/?after=10').get_data(as_text=True)
+                self.assertIn('Title 10', data)
+                self.assertNotIn('Title 9', data)
+                self.assertIn('before=11', data)
+                self.assertIn('after=20', data)
+
+                data = self.client.get('/?before=11').get_data(as_text=True)
+                self.assertIn('Title 0', data)
+                self.assertNotIn('Title 10', data)
+                self.assertNotIn('before=', data)
+
+                data = self.client.get('/?after=20').get_data(as_text=True)
+                self.assertIn('Title 24', data)
+                self.assertNotIn('after=', data)
+            finally:
+                app.config['PROJECTS_PER_PAGE'] = 20
+
+    def test_comments_page_query_budget(self):
+        # 项目 + 评论 + 每批评论一次回复查询，站长资料走进程内缓存
+        budget = 3
+        with app.app_context():
+            db.create_all()
+            db.session.add(User(username='TestUsername', name='Test User'))
+            project = Projects(title='Thread', content='')
+            db.session.add(project)
+            for i in range(30):
+                comment = Comment(author='guest%d' % i, content='comment %d' % i, project=project)
+                db.session.add(comment)
+                db.session.add_all([AdminReply(content='reply %d-%d' % (i, j), comment=comment) for j in range(2)])
+            db.session.commit()
+            project_id = project.id
+            db.session.remove()
+            self.client.get('/')    # 预热站长缓存
+
+            with self.count_queries() as statements:
+                response = self.client.get('/comments/%d' % project_id)
+            data = response.get_data(as_text=True)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('30 Comments', data)
+            self.assertIn('comment 29', data)
+            self.assertIn('reply 29-1', data)
+            self.assertLessEqual(len(statements), budget, statements)
+
+            # 超过一批时每批多一次回复查询：2 + ceil(30 / 8) = 6
+            app.config['COMMENT_CHUNK_SIZE'] = 8
+            self.addCleanup(app.config.__setitem__, 'COMMENT_CHUNK_SIZE', 200)
+            watchlist.page_cache.clear()
+            watchlist.comment_fragments.clear()
+            with self.count_queries() as statements:
+                data = self.client.get('/comments/%d?stream=1' % project_id).get_data(as_text=True)
+            self.assertIn('reply 29-1', data)
+            self.assertEqual(len(statements), 6, statements)
+
+    def test_comment_counters(self):
+        with app.app_context():
+            db.create_all()
+            user = User(username='TestUsername', name='Test User')
+            user.set_password('TestPassword')
+            db.session.add(user)
+            project = Projects(title='Thread', content='')
+            other = Projects(title='Other', content='')
+            db.session.add_all([project, other])
+            db.session.commit()
+            project_id, other_id = project.id, other.id
+
+            for i in range(3):
+                self.client.post('/comments/%d' % project_id, data=dict(author='guest', content='hello %d' % i))
+            self.assertEqual(db.session.get(Projects, project_id).comment_count, 3)
+
+            self.login('TestUsername', 'TestPassword')
+            comment_id = Comment.query.filter_by(project_id=project_id).first().id
+            self.client.post('/admin_reply/%d' % comment_id, data=dict(admin_reply='thanks'))
+            self.assertEqual(db.session.get(Comment, comment_id).reply_count, 1)
+            self.assertIn('3 Comments', self.client.get('/comments/%d' % project_id).get_data(as_text=True))
+
+            self.client.post('/movie/delete/%d' % project_id)
+            self.assertEqual(Comment.query.count(), 0)
+            self.assertEqual(AdminReply.query.count(), 0)
+
+            # 人为制造偏差后重建
+            db.session.execute(db.update(Projects).values(comment_count=7))
+            db.session.commit()
+            result = self.runner.invoke(args=['recount'])
+            self.assertIn('projects %d: comment_count 7 -> 0' % other_id, result.output)
+            self.assertIn('1 counter(s) drifted', result.output)
+            db.session.expire_all()
+            self.assertEqual(db.session.get(Projects, other_id).comment_count, 0)
+
+    def test_upgrade_backfills_counters(self):
+        with app.app_context():
+            db.create_all()
+            project = Projects(title='Old', content='')
+            comment = Comment(author='guest', content='hi', project=project)
+            db.session.add_all([project, comment, AdminReply(content='thanks', comment=comment)])
+            db.session.commit()
+            project_id, comment_id = project.id, comment.id
+            db.session.remove()
+            # 模拟升级前的库：还没有计数器列
+            with db.engine.begin() as conn:
+                conn.execute(db.text('ALTER TABLE projects DROP COLUMN comment_count'))
+                conn.execute(db.text('ALTER TABLE comment DROP COLUMN reply_count'))
+
+            self.runner.invoke(args=['initdb'])
+            self.assertEqual(db.session.get(Projects, project_id).comment_count, 1)
+            self.assertEqual(db.session.get(Comment, comment_id).reply_count, 1)
+
+    def test_upgrade_baseline_database(self):
+        with app.app_context():
+            # 最早版本建出来的库：没有 source、计数器、状态列，也没有全文索引
+            with db.engine.begin() as conn:
+                for ddl in (
+                    'CREATE TABLE user (id INTEGER PRIMARY KEY, name VARCHAR(20), username VARCHAR(20),'
+                    ' password_hash VARCHAR(128))',
+                    'CREATE TABLE projects (id INTEGER PRIMARY KEY, title VARCHAR(60), content TEXT)',
+                    'CREATE TABLE comment (id INTEGER PRIMARY KEY, author VARCHAR(20) NOT NULL, content TEXT NOT NULL,'
+                    ' timestamp DATETIME, project_id INTEGER REFERENCES projects (id))',
+                    'CREATE TABLE admin_reply (id INTEGER PRIMARY KEY, content TEXT NOT NULL, timestamp DATETIME,'
+                    ' comment_id INTEGER REFERENCES comment (id))',
+                    "INSERT INTO projects (id, title, content) VALUES (1, 'Legacy', '<p>about <em>gardening</em></p>')",
+                    "INSERT INTO comment (id, author, content, project_id) VALUES (1, 'guest', 'lovely tomatoes', 1)",
+                ):
+                    conn.execute(db.text(ddl))
+
+            for args in (['initdb'], ['reindex']):
+                result = self.runner.invoke(args=args)
+                self.assertIsNone(result.exception, result.output)
+
+            self.assertEqual(db.session.get(Projects, 1).comment_count, 1)
+            data = self.client.get('/search?q=gardening').get_data(as_text=True)
+            self.assertIn('Legacy', data)
+            data = self.client.get('/search?q=tomatoes').get_data(as_text=True)
+            self.assertIn('<mark>tomatoes</mark>', data)
+
+    def test_sqlite_pragmas(self):
+        with app.app_context():
+            db.create_all()
+            with db.engine.connect() as conn:
+                pragmas = dict(conn.execute(db.text(
+                    "SELECT 'journal_mode', * FROM pragma_journal_mode "
+                    "UNION ALL SELECT 'synchronous', * FROM pragma_synchronous "
+                    "UNION ALL SELECT 'busy_timeout', * FROM pragma_busy_timeout"
+                )).all())
+            self.assertEqual(pragmas['journal_mode'], 'wal')
+            self.assertEqual(pragmas['synchronous'], 1)
+            self.assertEqual(pragmas['busy_timeout'], 5000)
+
+            result = self.runner.invoke(args=['pragmas'])
+            self.assertIn('Profile: dev', result.output)
+            self.assertIn('journal_mode  wal', result.output)
+
+    def test_read_write_split(self):
+        with app.app_context():
+            db.create_all()
+            reader = db.engines['reader']
+            self.assertEqual(db.engine.pool.size(), 1)
+            db.session.add(Projects(title='Split', content=''))
+            db.session.commit()
+
+            self.assertIs(db.session.get_bind(clause=db.select(Projects)), reader)
+            self.assertIsNot(db.session.get_bind(clause=db.update(Projects)), reader)
+            with reader.connect() as conn:
+                self.assertEqual(conn.execute(db.text('PRAGMA query_only')).scalar(), 1)
+                with self.assertRaises(Exception):
+                    conn.execute(db.text("INSERT INTO projects (title) VALUES ('nope')"))
+            self.assertIn('Split', self.client.get('/').get_data(as_text=True))
+
+    def test_group_commit_queue(self):
+        with app.app_context():
+            db.create_all()
+            project = Projects(title='Busy', content='')
+            db.session.add(project)
+            db.session.commit()
+            project_id = project.id
+
+        app.config.update(WRITE_QUEUE_ENABLED=True, WRITE_QUEUE_MAX_DELAY=0.05)
+        try:
+            def post_comments(n):
+                client = app.test_client()
+                client.environ_base['REMOTE_ADDR'] = '10.0.0.%d' % n     # 每个线程一个访客，不触发限流
+                for i in range(5):
+                    client.post('/comments/%d' % project_id, data=dict(author='guest%d' % n, content='hi %d' % i))
+
+            threads = [threading.Thread(target=post_comments, args=(n,)) for n in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            stats = dict(watchlist.write_queue().stats)
+        finally:
+            watchlist.close_write_queue()
+            app.config.update(WRITE_QUEUE_ENABLED=False, WRITE_QUEUE_MAX_DELAY=0.005)
+
+        self.assertEqual(stats['items'], 40)
+        self.assertLess(stats['batches'], 40)
+        with app.app_context():
+            self.assertEqual(Comment.query.filter_by(project_id=project_id).count(), 40)
+            self.assertEqual(db.session.get(Projects, project_id).comment_count, 40)
+
+    def test_group_commit_queue_timeout(self):
+        with app.app_context():
+            db.create_all()
+            project = Projects(title='Slow', content='')
+            db.session.add(project)
+            db.session.commit()
+            project_id = project.id
+
+        # 批次迟迟不提交时请求不报 500，提示稍后查看；评论仍在队列里，之后照常写入
+        app.config.update(WRITE_QUEUE_ENABLED=True, WRITE_QUEUE_MAX_DELAY=0.5, WRITE_QUEUE_TIMEOUT=0.01)
+        try:
+            response = self.client.post('/comments/%d' % project_id, data=dict(author='guest', content='late'),
+                                        follow_redirects=True)
+        finally:
+            watchlist.close_write_queue()
+            app.config.update(WRITE_QUEUE_ENABLED=False, WRITE_QUEUE_MAX_DELAY=0.005, WRITE_QUEUE_TIMEOUT=10)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('评论提交较慢', response.get_data(as_text=True))
+        with app.app_context():
+            self.assertEqual(Comment.query.filter_by(project_id=project_id, content='late').count(), 1)
+
+    def test_import_command(self):
+        with app.app_context():
+            db.create_all()
+            with tempfile.TemporaryDirectory() as tmp:
+                projects_path = os.path.join(tmp, 'projects.jsonl')
+                with open(projects_path, 'w') as f:
+                    for i in range(1, 4):
+                        f.write(json.dumps({'id': i, 'title': 'Imported %d' % i, 'content': '', 'unknown': 1}) + '\n')
+                comments_path = os.path.join(tmp, 'comments.csv')
+                with open(comments_path, 'w') as f:
+                    f.write('author,content,project_id,timestamp\n')
+                    for i in range(10):
+                        f.write('guest,hello %d,%d,2023-01-02T03:04:05\n' % (i, i % 2 + 1))
+
+                result = self.runner.invoke(args=['import', projects_path, '--model', 'projects'])
+                self.assertIn('Imported 3 projects', result.output)
+                # 模拟中断后从第 4 条继续
+                result = self.runner.invoke(args=['import', comments_path, '--model', 'comments', '--offset', '4',
+                                                  '--batch-size', '2', '--commit-every', '4', '--defer-indexes'])
+                self.assertIn('resume with --offset 8', result.output)
+                self.assertIn('Imported 6 comments', result.output)
+
+                # 导入中途出错，删掉的索引也要建回来
+                broken_path = os.path.join(tmp, 'broken.jsonl')
+                with open(broken_path, 'w') as f:
+                    f.write(json.dumps({'author': 'guest', 'content': 'ok', 'project_id': 3}) + '\n')
+                    f.write(json.dumps({'author': None, 'content': 'bad', 'project_id': 3}) + '\n')
+                result = self.runner.invoke(args=['import', broken_path, '--model', 'comments', '--defer-indexes'])
+                self.assertIsNotNone(result.exception)
+                index_names = [index['name'] for index in db.inspect(db.engine).get_indexes('comment')]
+                self.assertIn('ix_comment_project_id', index_names)
+                self.assertIn('ix_comment_project_status', index_names)
+
+            self.assertEqual(Comment.query.count(), 6)
+            self.assertEqual(Comment.query.first().timestamp.year, 2023)
+            self.assertEqual([p.comment_count for p in Projects.query.order_by(Projects.id)], [3, 3, 0])
+            indexes = db.inspect(db.engine).get_indexes('comment')
+            self.assertIn('ix_comment_timestamp', [index['name'] for index in indexes])
+
+    def test_export(self):
+        with app.app_context():
+            db.create_all()
+            user = User(username='TestUsername', name='Test User')
+            user.set_password('TestPassword')
+            project = Projects(title='Exported', content='<p>hi</p>')
+            comment = Comment(author='guest', content='nice', project=project)
+            db.session.add_all([user, project, comment, AdminReply(content='thanks', comment=comment)])
+            db.session.commit()
+
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, 'export.jsonl.gz')
+                self.runner.invoke(args=['export', path, '--gzip'])
+                with gzip.open(path, 'rt', encoding='utf-8') as f:
+                    records = [json.loads(line) for line in f]
+            self.assertEqual(sorted(record['table'] for record in records),
+                             ['comments', 'projects', 'replies', 'users'])
+            exported = next(record for record in records if record['table'] == 'users')
+            self.assertEqual(sorted(exported), ['id', 'name', 'table', 'username', 'version'])
+            exported = next(record for record in records if record['table'] == 'projects')
+            self.assertEqual((exported['id'], exported['title'], exported['content'], exported['comment_count']),
+                             (project.id, 'Exported', '<p>hi</p>', 1))
+
+            self.assertEqual(self.client.get('/export').status_code, 302)
+            self.login('TestUsername', 'TestPassword')
+            response = self.client.get('/export?model=comments')
+            self.assertTrue(response.is_streamed)
+            lines = response.get_data(as_text=True).splitlines()
+            self.assertEqual(len(lines), 1)
+            self.assertEqual(json.loads(lines[0])['content'], 'nice')
+            self.assertNotIn('password_hash', self.client.get('/export?model=users').get_data(as_text=True))
+
+    def test_search(self):
+        with app.app_context():
+            db.create_all()
+            user = User(username='TestUsername', name='Test User')
+            user.set_password('TestPassword')
+            db.session.add(user)
+            db.session.add(Projects(title='Learning Flask', content='routing and templates'))
+            db.session.add(Projects(title='Other', content='nothing here'))
+            db.session.commit()
+            project = Projects.query.filter_by(title='Learning Flask').first()
+            project_id = project.id
+
+            self.client.post('/comments/%d' % project_id, data=dict(author='guest', content='<b>great</b> templates post'))
+            data = self.client.get('/search?q=templates').get_data(as_text=True)
+            self.assertIn('<mark>templates</mark>', data)
+            self.assertIn('&lt;b&gt;great&lt;/b&gt;', data)
+            self.assertNotIn('Other', data.split('search-results')[1])
+
+            self.login('TestUsername', 'TestPassword')
+            self.client.post('/edit/%d' % project_id, data=dict(content='jinja **macros**'))
+            data = self.client.get('/search?q=macros').get_data(as_text=True)
+            self.assertIn('<mark>macros</mark>', data)
+            self.assertNotIn('&lt;', data)
+            # 索引的是原文，渲染出来的 HTML 标签搜不到
+            self.assertIn('No results.', self.client.get('/search?q=strong').get_data(as_text=True))
+            # FTS 语法字符按普通文本处理
+            self.assertEqual(self.client.get('/search?q=%22AND(').status_code, 200)
+
+            self.client.post('/movie/delete/%d' % project_id)
+            self.assertIn('No results.', self.client.get('/search?q=templates').get_data(as_text=True))
+
+            # 没有原文的旧数据重建索引时去掉标签
+            db.session.add(Projects(title='Legacy', content='<p>old <em>archive</em></p>'))
+            db.session.commit()
+            result = self.runner.invoke(args=['reindex'])
+            self.assertIn('Search index rebuilt.', result.output)
+            self.assertIn('<mark>archive</mark>', self.client.get('/search?q=archive').get_data(as_text=True))
+            self.assertIn('No results.', self.client.get('/search?q=em').get_data(as_text=True))
+
+    def test_markdown_source_and_rerender(self):
+        with app.app_context():
+            db.create_all()
+            user = User(username='TestUsername', name='Test User')
+            user.set_password('TestPassword')
+            db.session.add(user)
+            project = Projects(title='Notes', content='')
+            db.session.add(project)
+            db.session.commit()
+            project_id = project.id
+
+            self.login('TestUsername', 'TestPassword')
+            self.client.post('/edit/%d' % project_id, data=dict(content='# Hello\n\n```\ncode\n```\n'))
+            project = db.session.get(Projects, project_id)
+            self.assertEqual(project.source, '# Hello\n\n```\ncode\n```\n')
+            self.assertIn('<h1>Hello</h1>', project.content)
+            self.assertEqual(project.rendered_with, watchlist.markdown_fingerprint())
+            # 编辑页显示原文而不是 HTML
+            data = self.client.get('/edit/%d' % project_id).get_data(as_text=True)
+            self.assertIn('# Hello', data)
+            self.assertNotIn('&lt;h1&gt;', data)
+
+            result = self.runner.invoke(args=['rerender', '--workers', '1'])
+            self.assertIn('0 document(s) re-rendered', result.output)
+            etag = self.client.get('/view/%d' % project_id).headers['ETag']
+            visitor = app.test_client()
+            listing = visitor.get('/api/projects').get_json()
+            app.config['MARKDOWN_EXTRAS'] = ['fenced-code-blocks']
+            try:
+                result = self.runner.invoke(args=['rerender', '--workers', '1'])
+                self.assertIn('1 document(s) re-rendered', result.output)
+                # 重新渲染后旧 ETag 失效
+                db.session.expire_all()
+                response = self.client.get('/view/%d' % project_id, headers={'If-None-Match': etag})
+                self.assertEqual(response.status_code, 200)
+                self.assertIn('<pre><code>code', response.get_data(as_text=True))
+                # JSON 列表里的 updated_at 也跟着变
+                response = visitor.get('/api/projects')
+                self.assertEqual(response.headers['X-Cache'], 'MISS')
+                self.assertNotEqual(response.get_json(), listing)
+                db.session.expire_all()
+                project = db.session.get(Projects, project_id)
+                self.assertIn('<pre><code>code', project.content)
+                self.assertEqual(project.rendered_with, watchlist.markdown_fingerprint())
+            finally:
+                app.config['MARKDOWN_EXTRAS'] = []
+
+    def test_page_cache(self):
+        with app.app_context():
+            db.create_all()
+            user = User(username='TestUsername', name='Test User')
+            user.set_password('TestPassword')
+            db.session.add(user)
+            project = Projects(title='Cached', content='')
+            db.session.add(project)
+            db.session.commit()
+            project_id = project.id
+
+        url = '/comments/%d' % project_id
+        self.assertEqual(self.client.get(url).headers['X-Cache'], 'MISS')
+        with app.app_context():
+            with self.count_queries() as statements:
+                response = self.client.get(url)
+        self.assertEqual(response.headers['X-Cache'], 'HIT')
+        self.assertEqual(statements, [])
+        self.assertEqual(self.client.get('/').headers['X-Cache'], 'MISS')
+        self.assertEqual(self.client.get('/').headers['X-Cache'], 'HIT')
+
+        # 评论只让这个项目的评论页和首页失效
+        self.client.get('/view/%d' % project_id)
+        self.client.post(url, data=dict(author='guest', content='fresh comment'))
+        response = self.client.get(url)
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        self.assertIn('fresh comment', response.get_data(as_text=True))
+        self.assertEqual(self.client.get('/').headers['X-Cache'], 'MISS')
+        self.assertEqual(self.client.get('/view/%d' % project_id).headers['X-Cache'], 'HIT')
+
+        # 登录用户不走缓存，改名后所有页面失效
+        admin = app.test_client()
+        admin.post('/login', data=dict(username='TestUsername', password='TestPassword'))
+        self.assertNotIn('X-Cache', admin.get('/').headers)
+        admin.post('/settings', data=dict(name='Renamed'))
+        response = self.client.get('/view/%d' % project_id)
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        self.assertIn("Renamed's Blog", response.get_data(as_text=True))
+        self.assertGreaterEqual(watchlist.page_cache.stats()['hits'], 3)
+
+        # 别的进程（其他 worker、flask 命令）失效页面后，本进程 memory 后端里的页面也要作废
+        self.assertEqual(self.client.get('/view/%d' % project_id).headers['X-Cache'], 'HIT')
+        watchlist.SharedValueCache(object, app.config['PAGE_CACHE_MARKER_PATH']).bump()
+        self.assertEqual(self.client.get('/view/%d' % project_id).headers['X-Cache'], 'MISS')
+        self.assertEqual(self.client.get('/view/%d' % project_id).headers['X-Cache'], 'HIT')
+
+    def test_conditional_get(self):
+        with app.app_context():
+            db.create_all()
+            user = User(username='TestUsername', name='Test User')
+            user.set_password('TestPassword')
+            db.session.add(user)
+            project = Projects(title='Conditional', content='<p>v1</p>')
+            db.session.add(project)
+            db.session.commit()
+            project_id = project.id
+
+        for cached in (False, True):
+            app.config['PAGE_CACHE_ENABLED'] = cached
+            try:
+                for url in ('/view/%d' % project_id, '/comments/%d' % project_id):
+                    response = self.client.get(url)
+                    etag = response.headers['ETag']
+                    response = self.client.get(url, headers={'If-None-Match': etag})
+                    self.assertEqual(response.status_code, 304)
+                    self.assertEqual(response.get_data(), b'')
+            finally:
+                app.config['PAGE_CACHE_ENABLED'] = True
+
+        url = '/comments/%d' % project_id
+        response = self.client.get(url)
+        etag, last_modified = response.headers['ETag'], response.headers['Last-Modified']
+        self.assertEqual(self.client.get(url, headers={'If-Modified-Since': last_modified}).status_code, 304)
+        self.client.post(url, data=dict(author='guest', content='new'))
+        self.assertEqual(self.client.get(url, headers={'If-None-Match': etag}).status_code, 200)
+
+        # 修改正文后旧 ETag 失效
+        view_etag = self.client.get('/view/%d' % project_id).headers['ETag']
+        self.login('TestUsername', 'TestPassword')
+        self.client.post('/edit/%d' % project_id, data=dict(content='v2'))
+        self.client.get('/logout')
+        response = self.client.get('/view/%d' % project_id, headers={'If-None-Match': view_etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('v2', response.get_data(as_text=True))
+
+    def test_owner_cache(self):
+        with app.app_context():
+            db.create_all()
+            user = User(username='TestUsername', name='Test User')
+            user.set_password('TestPassword')
+            db.session.add(user)
+            db.session.add(Projects(title='Owner', content=''))
+            db.session.commit()
+
+            app.config['PAGE_CACHE_ENABLED'] = False
+            try:
+                self.client.get('/')
+                with self.count_queries() as statements:
+                    data = self.client.get('/').get_data(as_text=True)
+                    self.client.get('/view/1')
+                    self.client.get('/missing')
+                self.assertIn("Test User's Blog", data)
+                self.assertFalse([sql for sql in statements if 'FROM user' in sql], statements)
+
+                loads = watchlist.owner_cache.loads
+                self.login('TestUsername', 'TestPassword')
+                self.client.post('/settings', data=dict(name='New Name'))
+                self.assertIn("New Name's Blog", self.client.get('/').get_data(as_text=True))
+                self.assertEqual(watchlist.owner_cache.loads, loads + 1)
+
+                # 另一个进程改了资料：标记文件被替换后本进程重新加载
+                db.session.execute(db.update(User).values(name='Elsewhere', version=User.version + 1))
+                db.session.commit()
+                self.assertNotIn('Elsewhere', self.client.get('/').get_data(as_text=True))
+                watchlist.owner_cache.bump()
+                self.assertIn("Elsewhere's Blog", self.client.get('/').get_data(as_text=True))
+            finally:
+                app.config['PAGE_CACHE_ENABLED'] = True
+
+    def test_session_user_snapshot(self):
+        with app.app_context():
+            db.create_all()
+            user = User(username='TestUsername', name='Test User')
+            user.set_password('TestPassword')
+            db.session.add(user)
+            db.session.commit()
+
+            self.login('TestUsername', 'TestPassword')
+            with self.count_queries() as statements:
+                data = self.client.get('/settings').get_data(as_text=True)
+            self.assertIn('value="Test User"', data)
+            self.assertFalse([sql for sql in statements if 'FROM user' in sql], statements)
+
+            self.client.post('/settings', data=dict(name='Renamed'))
+            with self.client.session_transaction() as sess:
+                self.assertEqual(sess['_user_snapshot'][2], 'Renamed')
+            self.client.get('/')    # 站长缓存在改名后重新加载一次
+            with self.count_queries() as statements:
+                data = self.client.get('/settings').get_data(as_text=True)
+            self.assertIn('value="Renamed"', data)
+            self.assertFalse([sql for sql in statements if 'FROM user' in sql], statements)
+
+            # 改密码会让版本号变化，下一次请求回数据库取最新记录
+            user = db.session.get(User, user.id)
+            user.set_password('Other')
+            db.session.commit()
+            with self.count_queries() as statements:
+                self.client.get('/settings')
+            self.assertTrue([sql for sql in statements if 'FROM user' in sql])
+
+            self.client.get('/logout')
+            with self.client.session_transaction() as sess:
+                self.assertNotIn('_user_snapshot', sess)
+
+    def test_compile_templates(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            target = os.path.join(tmp, 'compiled')
+            result = self.runner.invoke(args=['compile-templates', '--target', target])
+            self.assertIn('Compiled', result.output)
+
+            env = app.jinja_env
+            loader, bytecode_cache = env.loader, env.bytecode_cache
+            compiled = app.config['JINJA_COMPILED_TEMPLATES']
+            app.config.update(JINJA_COMPILED_TEMPLATES=target, JINJA_BYTECODE_CACHE_DIR=os.path.join(tmp, 'bytecode'))
+            try:
+                # 没有显式打开时不使用预编译模块
+                watchlist.configure_templates()
+                self.assertIs(env.loader, loader)
+                app.config['JINJA_USE_COMPILED_TEMPLATES'] = True
+                watchlist.configure_templates()
+                env.cache.clear()
+                template = env.get_template('comments.html')
+                self.assertTrue(template.filename.startswith(target))
+                self.assertEqual(os.listdir(os.path.join(tmp, 'bytecode')), [])
+                # 比源文件旧的模块被忽略
+                module = os.path.join(target, ModuleLoader.get_module_filename('comments.html'))
+                os.utime(module, (0, 0))
+                env.cache.clear()
+                self.assertFalse(env.get_template('comments.html').filename.startswith(target))
+                env.loader = loader
+                env.cache.clear()
+                env.get_template('login.html')
+                self.assertTrue(os.listdir(os.path.join(tmp, 'bytecode')))
+            finally:
+                env.loader, env.bytecode_cache = loader, bytecode_cache
+                app.config.update(JINJA_COMPILED_TEMPLATES=compiled, JINJA_BYTECODE_CACHE_DIR=None,
+                                  JINJA_USE_COMPILED_TEMPLATES=False)
+                env.cache.clear()
+
+    def test_build_static(self):
+        dist = os.path.join(app.static_folder, app.config['STATIC_DIST_DIR'])
+        try:
+            result = self.runner.invoke(args=['build-static'])
+            self.assertIn('Built 4 static files.', result.output)
+            with app.app_context():
+                db.create_all()
+                html = self.client.get('/').get_data(as_text=True)
+            css_url = re.search(r'/static/dist/style\.[0-9a-f]{12}\.css', html).group(0)
+            self.assertNotIn('/static/style.css', html)
+
+            response = self.client.get(css_url, headers={'Accept-Encoding': 'gzip, br'})
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(response.mimetype, 'text/css')
+            self.assertIn('immutable', response.headers['Cache-Control'])
+            with open(os.path.join(app.static_folder, 'style.css'), 'rb') as f:
+                self.assertEqual(gzip.decompress(response.get_data()), f.read())
+            response.close()
+
+            response = self.client.get(css_url)
+            self.assertNotIn('Content-Encoding', response.headers)
+            self.assertIn('max-age=31536000', response.headers['Cache-Control'])
+            response.close()
+        finally:
+            shutil.rmtree(dist, ignore_errors=True)
+            watchlist.load_static_manifest()
+            watchlist.page_cache.clear()
+
+    def test_gzip_middleware(self):
+        with app.app_context():
+            db.create_all()
+            project = Projects(title='Zipped', content='')
+            db.session.add(project)
+            db.session.add_all([Comment(author='guest', content='comment %d' % i, project=project) for i in range(50)])
+            db.session.commit()
+            project_id = project.id
+
+        metrics = []
+        middleware = GzipMiddleware(app.wsgi_app, min_size=200,
+                                    on_metrics=lambda environ, bytes_in, bytes_out: metrics.append((bytes_in, bytes_out)))
+        client = Client(middleware)
+        url = '/comments/%d' % project_id
+        plain = client.get(url)
+        self.assertNotIn('Content-Encoding', plain.headers)
+
+        response = client.get(url, headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertTrue(response.headers['ETag'].startswith('W/'))
+        self.assertEqual(gzip.decompress(response.get_data()), plain.get_data())
+        self.assertEqual(metrics[-1][0], len(plain.get_data()))
+        self.assertLess(metrics[-1][1], metrics[-1][0])
+
+        # 弱 ETag 仍然可以换来 304
+        response = client.get(url, headers={'Accept-Encoding': 'gzip', 'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+        # 流式响应逐块压缩，小响应和 gzip;q=0 不压缩
+        def streaming_app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return (('line %d\n' % i).encode() for i in range(1000))
+
+        response = Client(GzipMiddleware(streaming_app)).get('/', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.get_data()).count(b'\n'), 1000)
+        response = Client(GzipMiddleware(streaming_app, min_size=10 ** 6)).get('/', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        response = client.get(url, headers={'Accept-Encoding': 'gzip;q=0'})
+        self.assertNotIn('Content-Encoding', response.headers)
+
+    def test_comment_fragment_cache(self):
+        with app.app_context():
+            db.create_all()
+            user = User(username='TestUsername', name='Test User')
+            user.set_password('TestPassword')
+            db.session.add(user)
+            project = Projects(title='Fragments', content='')
+            db.session.add(project)
+            db.session.add_all([Comment(author='guest', content='comment %d' % i, project=project) for i in range(20)])
+            db.session.commit()
+            project_id = project.id
+            first_comment = Comment.query.filter_by(project_id=project_id).order_by(Comment.id).first().id
+
+        self.login('TestUsername', 'TestPassword')    # 登录后不走整页缓存
+        url = '/comments/%d' % project_id
+        self.client.get(url)
+        self.assertEqual(watchlist.comment_fragments.stats()['entries'], 20)
+
+        with app.app_context():
+            with self.count_queries() as statements:
+                data = self.client.get(url).get_data(as_text=True)
+        self.assertIn('comment 19', data)
+        self.assertFalse([sql for sql in statements if 'admin_reply' in sql], statements)
+
+        # 新回复只让这一条评论重新渲染
+        misses = watchlist.comment_fragments.stats()['misses']
+        self.client.post('/admin_reply/%d' % first_comment, data=dict(admin_reply='thanks!'))
+        data = self.client.get(url).get_data(as_text=True)
+        self.assertIn('Admin: thanks!', data)
+        self.assertEqual(watchlist.comment_fragments.stats()['misses'], misses + 1)
+
+    def test_streamed_comments(self):
+        app.config['COMMENT_CHUNK_SIZE'] = 7
+        self.addCleanup(app.config.__setitem__, 'COMMENT_CHUNK_SIZE', 200)
+        with app.app_context():
+            db.create_all()
+            project = Projects(title='Long thread', content='')
+            db.session.add(project)
+            for i in range(40):
+                comment = Comment(author='guest', content='comment %d' % i, project=project)
+                db.session.add(comment)
+                db.session.add(AdminReply(content='reply %d' % i, comment=comment))
+            db.session.commit()
+            project_id = project.id
+
+        url = '/comments/%d' % project_id
+        response = self.client.get(url + '?stream=1', buffered=False)
+        self.assertTrue(response.is_streamed)
+        self.assertTrue(response.headers['ETag'])
+        chunks = [chunk.decode('utf-8') for chunk in response.response]
+        response.close()
+        # 页头单独成块先发出，整页分成多块
+        self.assertIn('40 Comments', chunks[0])
+        self.assertNotIn('comment 39', chunks[0])
+        self.assertGreater(len(chunks), 2)
+        data = ''.join(chunks)
+        self.assertEqual(data.count('class="comment-item"'), 40)
+        self.assertLess(data.index('comment 7'), data.index('comment 8'))
+        self.assertIn('reply 39', data)
+        # 与整页渲染的结果一致
+        self.assertEqual(data, self.client.get(url).get_data(as_text=True))
+        # 流式发送的整页同样进入页面缓存
+        response = self.client.get(url + '?stream=1')
+        self.assertEqual(response.headers['X-Cache'], 'HIT')
+        self.assertEqual(response.get_data(as_text=True), data)
+
+        # 超过单页上限的流式页照常发完，但不进缓存
+        watchlist.page_cache.clear()
+        app.config['PAGE_CACHE_MAX_ENTRY_BYTES'] = len(data) // 2
+        self.addCleanup(app.config.__setitem__, 'PAGE_CACHE_MAX_ENTRY_BYTES', 1024 * 1024)
+        self.assertEqual(self.client.get(url + '?stream=1').get_data(as_text=True), data)
+        self.assertEqual(self.client.get(url + '?stream=1').headers['X-Cache'], 'MISS')
+
+    def test_cache_stats(self):
+        with app.app_context():
+            db.create_all()
+        app.config['CACHE_STATS_LOG_INTERVAL'] = 0.001
+        self.addCleanup(app.config.__setitem__, 'CACHE_STATS_LOG_INTERVAL', 300)
+        self.client.get('/')
+        with self.assertLogs(app.logger, 'INFO') as logs:
+            self.client.get('/')
+        self.assertTrue(any(re.search(r'cache pages: hits=\d+ misses=\d+ hit_rate=[\d.]+% entries=1 ', line)
+                            for line in logs.output), logs.output)
+        self.assertTrue(any('cache fragments:' in line for line in logs.output))
+        self.assertTrue(any('cache markdown:' in line for line in logs.output))
+
+        result = self.runner.invoke(args=['cache-stats'])
+        self.assertIn('Backend: memory', result.output)
+        self.assertIn('server log', result.output)
+
+    def test_cache_backends(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for backend in ('memory', 'filesystem', 'sqlite'):
+            with self.subTest(backend=backend):
+                cache = create_cache(backend, 'test', directory=directory, max_entries=3)
+                cache.set(('page', 1), b'one', tags=('index',))
+                cache.set(('page', 2), b'two', tags=('project:2',))
+                cache.set('short', 'lived', ttl=-1)
+                self.assertEqual(cache.get(('page', 1)), b'one')
+                self.assertIsNone(cache.get('short'))
+
+                cache.invalidate('index')
+                self.assertIsNone(cache.get(('page', 1)))
+                self.assertEqual(cache.get(('page', 2)), b'two')
+                stats = cache.stats()
+                self.assertEqual((stats['hits'], stats['misses']), (2, 2))
+
+                # 超出条数上限时淘汰最早的条目
+                for i in range(5):
+                    cache.set(('bulk', i), i)
+                if backend != 'memory':
+                    cache.prune()
+                self.assertLessEqual(cache.stats()['entries'], 3)
+                self.assertEqual(cache.get(('bulk', 4)), 4)
+
+                if backend != 'memory':
+                    # 另一个进程（这里用新实例模拟）看得到同一份数据和失效
+                    other = create_cache(backend, 'test', directory=directory, max_entries=3)
+                    self.assertEqual(other.get(('bulk', 4)), 4)
+                    other.clear()
+                    self.assertIsNone(cache.get(('bulk', 4)))
+
+    def test_json_api(self):
+        with app.app_context():
+            db.create_all()
+            projects = [Projects(title='Title %d' % i, content='<p>%d</p>' % i) for i in range(5)]
+            db.session.add_all(projects)
+            db.session.add_all([Comment(author='guest', content='comment %d' % i, project=projects[0])
+                                for i in range(3)])
+            db.session.commit()
+            project_id = projects[0].id
+
+        response = self.client.get('/api/projects?limit=2&fields=title')
+        self.assertEqual(response.mimetype, 'application/json')
+        page = response.get_json()
+        self.assertEqual(page['items'], [{'id': 1, 'title': 'Title 0'}, {'id': 2, 'title': 'Title 1'}])
+        self.assertEqual(page['next'], 2)
+        page = self.client.get('/api/projects?limit=2&after=4').get_json()
+        self.assertEqual([item['id'] for item in page['items']], [5])
+        self.assertIsNone(page['next'])
+        self.assertEqual(page['items'][0]['comment_count'], 0)
+        self.assertEqual(self.client.get('/api/projects?fields=password').status_code, 400)
+
+        response = self.client.get('/api/projects/%d' % project_id)
+        self.assertEqual(response.get_json()['content'], '<p>0</p>')
+        self.assertEqual(response.get_json()['comment_count'], 3)
+        etag = response.headers['ETag']
+        response = self.client.get('/api/projects/%d' % project_id, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.client.get('/api/projects/999').get_json(), {'error': 'project 999 not found'})
+
+        url = '/api/projects/%d/comments?fields=content&limit=2' % project_id
+        page = self.client.get(url).get_json()
+        self.assertEqual([item['content'] for item in page['items']], ['comment 0', 'comment 1'])
+        self.assertEqual(self.client.get(url).headers['X-Cache'], 'HIT')
+        # 新评论让缓存和 ETag 一起失效
+        self.client.post('/comments/%d' % project_id, data=dict(author='guest', content='comment 3'))
+        page = self.client.get(url + '&after=%d' % page['next']).get_json()
+        self.assertEqual([item['content'] for item in page['items']], ['comment 2', 'comment 3'])
+        self.assertEqual(self.client.get('/api/projects/%d' % project_id).get_json()['comment_count'], 4)
+
+    def test_json_api_batch(self):
+        with app.app_context():
+            db.create_all()
+            db.session.add_all([Projects(title='Title %d' % i, content='') for i in range(5)])
+            db.session.commit()
+
+            with self.count_queries() as statements:
+                page = self.client.get('/api/projects/batch?ids=3,1,42,3&fields=title').get_json()
+            self.assertEqual(page['items'], [{'id': 3, 'title': 'Title 2'}, {'id': 1, 'title': 'Title 0'}])
+            self.assertEqual(page['missing'], [42])
+            self.assertEqual(len(statements), 1, statements)
+
+        page = self.client.post('/api/projects/batch', json={'ids': [5, 6]}).get_json()
+        self.assertEqual([item['title'] for item in page['items']], ['Title 4'])
+        self.assertEqual(page['missing'], [6])
+        self.assertEqual(self.client.get('/api/projects/batch?ids=1,x').status_code, 400)
+        for body in ([1, 2], {'ids': '12'}, {'ids': [1, '2']}, {'ids': [True]}, {}):
+            self.assertEqual(self.client.post('/api/projects/batch', json=body).status_code, 400, body)
+        too_many = ','.join(str(i) for i in range(app.config['API_BATCH_MAX_IDS'] + 1))
+        self.assertEqual(self.client.get('/api/projects/batch?ids=' + too_many).status_code, 400)
+
+    def test_blocklist(self):
+        blocklist = watchlist.Blocklist(['# comment', 'Cheap Pills', 'https://www.evil.example/landing', 'spam'])
+        self.assertEqual((blocklist.terms, blocklist.domains), ({'cheap pills', 'spam'}, {'evil.example'}))
+        self.assertEqual(blocklist.match('CHEAP\u200b  pills here'), 'cheap pills')
+        self.assertEqual(blocklist.match('ｓｐａｍ'), 'spam')
+        self.assertEqual(blocklist.match('see http://cdn.Evil.Example/x'), 'evil.example')
+        self.assertEqual(blocklist.match('or evil[.]example'), 'evil.example')
+        self.assertIsNone(blocklist.match('notevil.example is fine'))
+
+        # 改了词表文件，不重启也会生效
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'blocklist.txt')
+        with open(path, 'w') as f:
+            f.write('badword1\n')
+        original = app.config['BLOCKLIST_PATH'], watchlist.blocklist.marker_path
+        app.config['BLOCKLIST_PATH'] = watchlist.blocklist.marker_path = path
+        self.addCleanup(watchlist.blocklist.clear)
+        self.addCleanup(setattr, watchlist.blocklist, 'marker_path', original[1])
+        self.addCleanup(app.config.__setitem__, 'BLOCKLIST_PATH', original[0])
+
+        self.assertTrue(watchlist.contains_malicious_content('BadWord1!'))
+        self.assertFalse(watchlist.contains_malicious_content('buy at shop.example'))
+        with open(path + '.new', 'w') as f:
+            f.write('shop.example\n')
+        os.replace(path + '.new', path)
+        self.assertTrue(watchlist.contains_malicious_content('buy at www.shop.example'))
+        self.assertFalse(watchlist.contains_malicious_content('BadWord1!'))
+
+    def test_comment_rate_limit(self):
+        limiter = watchlist.SlidingWindowLimiter(limit=2, window=60)
+        self.assertEqual([limiter.hit('a', now=t) for t in (0, 1)], [0, 0])
+        self.assertEqual(limiter.hit('a', now=2), 88)
+        # 88 秒后处在下一个窗口的一半，上一窗口的 2 次只算 1 次
+        self.assertEqual(limiter.hit('a', now=90), 0)
+        self.assertEqual(limiter.hit('b', now=250), 0)
+        self.assertEqual(len(limiter), 1)   # 'a' 两个窗口没动静，已被清掉
+        # 有一个键拒绝时，其余键也不计数
+        self.assertEqual([limiter.hit_all(['ip', 'alice'], now=300) for _ in range(2)], [0, 0])
+        self.assertGreater(limiter.hit_all(['ip', 'bob'], now=301), 0)
+        self.assertEqual(limiter.hit_all(['other-ip', 'bob'], now=301), 0)
+        self.assertEqual(limiter.hit('bob', now=302), 0)
+
+        with app.app_context():
+            db.create_all()
+            project = Projects(title='Busy', content='')
+            db.session.add(project)
+            db.session.commit()
+            project_id = project.id
+
+        url = '/comments/%d' % project_id
+        app.config['RATE_LIMIT_PROXY_HEADERS'] = ['X-Forwarded-For']
+        self.addCleanup(app.config.__setitem__, 'RATE_LIMIT_PROXY_HEADERS', [])
+        for i in range(app.config['COMMENT_RATE_LIMIT']):
+            response = self.client.post(url, data=dict(author='guest%d' % i, content='hi'),
+                                        headers={'X-Forwarded-For': '6.6.6.6, 1.2.3.4'})
+            self.assertEqual(response.status_code, 200)
+        with app.app_context():
+            with self.count_queries() as statements:
+                response = self.client.post(url, data=dict(author='someone', content='hi'),
+                                            headers={'X-Forwarded-For': '7.7.7.7, 1.2.3.4'})
+        self.assertEqual(response.status_code, 429)
+        self.assertGreaterEqual(int(response.headers['Retry-After']), 1)
+        self.assertEqual(statements, [])
+        # 被限的 IP 换署名继续发，也不会占用这个署名的额度
+        for i in range(app.config['COMMENT_RATE_LIMIT']):
+            self.client.post(url, data=dict(author='victim', content='hi'), headers={'X-Forwarded-For': '1.2.3.4'})
+        response = self.client.post(url, data=dict(author='victim', content='hi'), headers={'X-Forwarded-For': '4.4.4.4'})
+        self.assertEqual(response.status_code, 200)
+        # 另一个客户端不受影响；同一署名换 IP 也会被限
+        response = self.client.post(url, data=dict(author='other', content='hi'), headers={'X-Forwarded-For': '5.6.7.8'})
+        self.assertEqual(response.status_code, 200)
+        for i in range(app.config['COMMENT_RATE_LIMIT'] - 1):
+            self.client.post(url, data=dict(author='other', content='hi'), headers={'X-Forwarded-For': '9.9.9.%d' % i})
+        response = self.client.post(url, data=dict(author='Other', content='hi'), headers={'X-Forwarded-For': '8.8.8.8'})
+        self.assertEqual(response.status_code, 429)
+
+    def test_comment_moderation(self):
+        with app.app_context():
+            db.create_all()
+            project = Projects(title='Moderated', content='')
+            db.session.add(project)
+            db.session.commit()
+            project_id = project.id
+
+        app.config['MODERATION_ENABLED'] = True
+        self.addCleanup(app.config.__setitem__, 'MODERATION_ENABLED', False)
+        self.addCleanup(watchlist.close_moderation_pool)
+        url = '/comments/%d' % project_id
+        posts = [('alice', 'nice post'), ('bob', 'buy badword1 now'), ('carol', 'nice post'),
+                 ('alice', 'nice post'), ('dave', 'http://a.example http://b.example www.c.example')]
+        for i, (author, content) in enumerate(posts):
+            response = self.client.post(url, data=dict(author=author, content=content),
+                                        environ_base={'REMOTE_ADDR': '10.0.1.%d' % i}, follow_redirects=True)
+            self.assertIn('审核通过后显示', response.get_data(as_text=True))
+        watchlist.moderation_pool().join()
+
+        with app.app_context():
+            statuses = db.session.execute(db.select(Comment.author, Comment.status)).all()
+            # 同样的内容换个作者可以发，同一作者重复发才算刷屏（两条由不同 worker 处理，先处理的那条通过）
+            self.assertEqual(sorted(tuple(row) for row in statuses),
+                             [('alice', 'published'), ('alice', 'rejected'), ('bob', 'rejected'),
+                              ('carol', 'published'), ('dave', 'rejected')])
+            self.assertEqual(db.session.get(Projects, project_id).comment_count, 2)
+
+            # 重启前没来得及处理的评论由 flask moderate 补上；同一作者隔了很久再发同样的话不算重复
+            db.session.add(Comment(author='erin', content='late but fine', project_id=project_id,
+                                   timestamp=datetime.utcnow() - timedelta(days=2)))
+            db.session.add(Comment(author='erin', content='late but fine', project_id=project_id, status='pending'))
+            db.session.commit()
+            self.assertEqual(self.client.get(url).get_data(as_text=True).count('class="comment-item"'), 3)
+        result = self.runner.invoke(args=['moderate'])
+        self.assertIn('Published 1, rejected 0.', result.output)
+
+        data = self.client.get(url).get_data(as_text=True)
+        self.assertIn('4 Comments', data)
+        self.assertIn('late but fine', data)
+        self.assertNotIn('badword1', data)
+        with app.app_context():
+            self.assertEqual(watchlist.rebuild_counters(), [])
+
     # comment还没写...
 
 if __name__ == '__main__':
@@ -0,0 +1,82 @@
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class BatchWorkerPool:
+    """Hand submitted items to ``handle_batch(items)`` on background threads, a batch at a time.
+
+    Each worker takes up to ``batch_size`` items, waiting at most ``max_delay`` seconds to fill
+    a batch. A batch that raises is logged and counted in ``stats['failures']``; its items are
+    not retried here.
+    """
+
+    def __init__(self, handle_batch, workers=2, batch_size=50, max_delay=0.05, name='batch-worker'):
+        self.handle_batch = handle_batch
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.stats = {'items': 0, 'batches': 0, 'failures': 0}
+        self._queue = queue.Queue()
+        self._closed = False
+        self._threads = [threading.Thread(target=self._run, name='%s-%d' % (name, i), daemon=True)
+                         for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, item):
+        if self._closed:
+            raise RuntimeError('worker pool is closed')
+        self._queue.put(item)
+
+    def join(self):
+        """Block until every submitted item has been handled."""
+        self._queue.join()
+
+    def close(self, timeout=None):
+        """Handle whatever is still queued and stop the workers."""
+        if not self._closed:
+            self._closed = True
+            for _ in self._threads:
+                self._queue.put(None)
+            for thread in self._threads:
+                thread.join(timeout)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            stop = False
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.task_done()
+                    stop = True
+                    break
+                batch.append(item)
+            self._handle(batch)
+            if stop:
+                return
+
+    def _handle(self, batch):
+        try:
+            self.handle_batch(batch)
+        except Exception:
+            self.stats['failures'] += 1
+            logger.exception('batch of %d items failed', len(batch))
+        else:
+            self.stats['batches'] += 1
+            self.stats['items'] += len(batch)
+        finally:
+            for _ in batch:
+                self._queue.task_done()
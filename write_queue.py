@@ -0,0 +1,78 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class GroupCommitQueue:
+    """Collect writes from many threads and commit them in batches on one writer thread.
+
+    ``apply_batch(connection, items)`` runs inside a single transaction and returns one
+    result per item; each caller's future resolves only after that transaction commits.
+    """
+
+    def __init__(self, engine, apply_batch, max_delay=0.005, batch_size=100):
+        self.engine = engine
+        self.apply_batch = apply_batch
+        self.max_delay = max_delay
+        self.batch_size = batch_size
+        self.stats = {'items': 0, 'batches': 0, 'failures': 0}
+        self._queue = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='group-commit', daemon=True)
+        self._thread.start()
+
+    def submit(self, item):
+        if self._closed:
+            raise RuntimeError('write queue is closed')
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def close(self, timeout=None):
+        """Commit whatever is still queued and stop the writer thread."""
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+            self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            entry = self._queue.get()
+            if entry is None:
+                return
+            batch = [entry]
+            # 等到攒够一批或者超过最长延迟再提交，一次 fsync 确认整批写入
+            deadline = time.monotonic() + self.max_delay
+            stop = False
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    entry = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if entry is None:
+                    stop = True
+                    break
+                batch.append(entry)
+            self._commit(batch)
+            if stop:
+                return
+
+    def _commit(self, batch):
+        try:
+            with self.engine.begin() as conn:
+                results = self.apply_batch(conn, [item for item, _ in batch])
+        except Exception as e:
+            self.stats['failures'] += 1
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            # 整批失败时逐条重试，只让出错的那条请求收到异常
+            for entry in batch:
+                self._commit([entry])
+            return
+        self.stats['batches'] += 1
+        self.stats['items'] += len(batch)
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
@@ -6,6 +6,16 @@ if os.path.exists(dotenv_path):
     load_dotenv(dotenv_path)
 
 from app import app
+from gzip_middleware import GzipMiddleware
+
+
+def log_gzip_savings(environ, bytes_in, bytes_out):
+    app.logger.debug('gzip %s: %d -> %d bytes (saved %d)', environ.get('PATH_INFO'),
+                     bytes_in, bytes_out, bytes_in - bytes_out)
+
+
+app.wsgi_app = GzipMiddleware(app.wsgi_app, min_size=app.config['GZIP_MIN_SIZE'],
+                              level=app.config['GZIP_LEVEL'], on_metrics=log_gzip_savings)
 
 if __name__  ==  "__main__":
     app.run()